@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+from queue_manager import QueuedSong
+
+# Directory for cached tracks; leave unset to disable the cache
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', '')
+AUDIO_CACHE_MAX_MB = int(os.getenv('AUDIO_CACHE_MAX_MB', '1024'))
+# Plays before a track is considered hot enough to keep locally
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', '3'))
+# Background transcodes allowed at once
+AUDIO_CACHE_TRANSCODES = int(os.getenv('AUDIO_CACHE_TRANSCODES', '1'))
+# Play counters kept for tracks that are not cached
+PLAY_COUNT_ROWS = 50000
+
+class AudioCache:
+    """Keeps frequently played tracks on disk as Opus files
+
+    Every play is counted; once a track reaches `min_plays` its stream is
+    transcoded in the background by FFmpeg. When the cache grows past
+    `max_bytes` the least frequently played files go first, oldest play
+    breaking ties.
+    """
+    def __init__(self, directory: str = AUDIO_CACHE_DIR, max_mb: int = AUDIO_CACHE_MAX_MB,
+                 min_plays: int = AUDIO_CACHE_MIN_PLAYS, transcodes: int = AUDIO_CACHE_TRANSCODES):
+        self.enabled = bool(directory)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.min_plays = min_plays
+        self._transcodes = transcodes
+        self._semaphore = None  # (loop, Semaphore); rebuilt for each loop that stores tracks
+        self._storing = set()
+        if not self.enabled:
+            return
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.directory / 'index.db')
+        # Shard workers share the cache directory and its index
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS tracks (
+                key TEXT PRIMARY KEY,
+                plays INTEGER NOT NULL DEFAULT 0,
+                last_played REAL NOT NULL,
+                path TEXT,
+                size INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS idx_tracks_eviction ON tracks (plays, last_played)')
+        self._db.commit()
+
+    def lookup(self, song: QueuedSong) -> Optional[str]:
+        """Path of the cached file for a song, if it is cached and still on disk"""
+        if not self.enabled:
+            return None
+        row = self._db.execute('SELECT path FROM tracks WHERE key = ?', (song.video_id,)).fetchone()
+        if not row or not row[0]:
+            return None
+        if not os.path.exists(row[0]):
+            self._db.execute('UPDATE tracks SET path = NULL, size = 0 WHERE key = ?', (song.video_id,))
+            self._db.commit()
+            return None
+        return row[0]
+
+    def record_play(self, song: QueuedSong) -> None:
+        """Count a play and start caching the track once it becomes hot"""
+        if not self.enabled:
+            return
+        self._db.execute(
+            '''INSERT INTO tracks (key, plays, last_played) VALUES (?, 1, ?)
+               ON CONFLICT(key) DO UPDATE SET plays = plays + 1, last_played = excluded.last_played''',
+            (song.video_id, time.time())
+        )
+        self._db.commit()
+        row = self._db.execute('SELECT plays, path FROM tracks WHERE key = ?', (song.video_id,)).fetchone()
+        if row[0] >= self.min_plays and not row[1] and song.stream_url and song.video_id not in self._storing:
+            asyncio.get_running_loop().create_task(self._store(song.video_id, song.stream_url))
+
+    def _transcode_slots(self) -> asyncio.Semaphore:
+        """The running loop's transcode semaphore; one made on an earlier loop can't be awaited here"""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = (loop, asyncio.Semaphore(self._transcodes))
+        return self._semaphore[1]
+
+    async def _store(self, key: str, stream_url: str) -> None:
+        """Transcode a stream to a local Opus file"""
+        self._storing.add(key)
+        name = hashlib.sha1(key.encode()).hexdigest()
+        final = self.directory / f"{name}.opus"
+        partial = self.directory / f"{name}.opus.{os.getpid()}.part"
+        try:
+            async with self._transcode_slots():
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+                    '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+                    '-i', stream_url, '-vn', '-map', '0:a:0',
+                    '-c:a', 'libopus', '-b:a', '128k', '-ar', '48000', '-ac', '2',
+                    '-f', 'ogg', str(partial),
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                raise Exception(stderr.decode(errors='replace').strip() or f"ffmpeg exited with {process.returncode}")
+
+            os.replace(partial, final)
+            self._db.execute(
+                'UPDATE tracks SET path = ?, size = ? WHERE key = ?',
+                (str(final), final.stat().st_size, key)
+            )
+            self._db.commit()
+            self._evict()
+        except Exception as e:
+            print(f"Error caching audio for {key}: {e}")
+            partial.unlink(missing_ok=True)
+        finally:
+            self._storing.discard(key)
+
+    def _evict(self) -> None:
+        """Delete the least frequently played files until under the size cap"""
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM tracks').fetchone()[0]
+        if total > self.max_bytes:
+            victims = self._db.execute(
+                'SELECT key, path, size FROM tracks WHERE path IS NOT NULL ORDER BY plays, last_played'
+            ).fetchall()
+            for key, path, size in victims:
+                if total <= self.max_bytes:
+                    break
+                Path(path).unlink(missing_ok=True)
+                self._db.execute('UPDATE tracks SET path = NULL, size = 0 WHERE key = ?', (key,))
+                total -= size
+
+        # Forget play counts of long-unplayed, uncached tracks
+        self._db.execute(
+            '''DELETE FROM tracks WHERE key IN (
+                SELECT key FROM tracks WHERE path IS NULL ORDER BY last_played DESC LIMIT -1 OFFSET ?
+            )''',
+            (PLAY_COUNT_ROWS,)
+        )
+        self._db.commit()
+
+    def stats(self) -> dict:
+        """Number and total size of cached files"""
+        if not self.enabled:
+            return {'files': 0, 'bytes': 0}
+        files, size = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tracks WHERE path IS NOT NULL'
+        ).fetchone()
+        return {'files': files, 'bytes': size}
+
+audio_cache = AudioCache()
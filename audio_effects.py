@@ -0,0 +1,197 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+
+# Loudness targets for normalization: integrated (LUFS), true peak (dBTP) and range (LU)
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', '-16'))
+LOUDNESS_PEAK = -1.5
+LOUDNESS_RANGE = 11
+# Whether guilds start with normalization switched on
+NORMALIZE_DEFAULT = os.getenv('NORMALIZE_DEFAULT', '').lower() in ('1', 'true', 'yes')
+LOUDNESS_CACHE_PATH = os.getenv('LOUDNESS_CACHE_PATH', 'loudness_cache.db')
+# Background loudness measurements allowed at once; longer tracks are never measured
+LOUDNESS_MEASUREMENTS = int(os.getenv('LOUDNESS_MEASUREMENTS', '1'))
+LOUDNESS_MAX_SECONDS = 900
+
+# Output rate discord.py expects; speed effects resample back to it
+SAMPLE_RATE = 48000
+
+# Peaking EQ bands as (frequency Hz, gain dB)
+EQ_PRESETS = {
+    'flat': (),
+    'bass': ((60, 5), (150, 3), (400, -1)),
+    'treble': ((4000, 3), (8000, 4), (12000, 4)),
+    'vocal': ((250, -2), (1000, 2), (3000, 4), (6000, 2)),
+    'rock': ((80, 4), (250, 2), (1000, -2), (4000, 3), (10000, 4)),
+    'pop': ((100, -1), (500, 2), (1500, 4), (4000, 2), (10000, -1)),
+}
+# Speed presets as (factor, whether the pitch moves with it)
+SPEED_PRESETS = {
+    'normal': (1.0, False),
+    'nightcore': (1.25, True),
+    'vaporwave': (0.8, True),
+}
+MAX_BASS_BOOST = 20
+MAX_CROSSFADE = 10
+
+@dataclass(frozen=True)
+class AudioEffects:
+    """A guild's effect settings; frozen so a stream's copy never changes under it"""
+    normalize: bool = NORMALIZE_DEFAULT
+    eq: str = 'flat'
+    bass: int = 0  # Bass boost in dB
+    speed: float = 1.0  # Track seconds per second of output
+    pitch: bool = False  # Speed changes pitch too (nightcore) rather than only tempo
+    crossfade: float = 0  # Seconds faded in and out at track boundaries
+
+    def describe(self) -> str:
+        parts = []
+        if self.normalize:
+            parts.append(f"normalize ({LOUDNESS_TARGET:g} LUFS)")
+        if self.eq != 'flat':
+            parts.append(f"eq {self.eq}")
+        if self.bass:
+            parts.append(f"bass +{self.bass}dB")
+        if self.speed != 1.0:
+            name = next((name for name, preset in SPEED_PRESETS.items() if preset == (self.speed, self.pitch)), None)
+            parts.append(f"speed {name or f'{self.speed:g}x'}")
+        if self.crossfade:
+            parts.append(f"crossfade {self.crossfade:g}s")
+        return ', '.join(parts) or 'none'
+
+def build_filter(effects: AudioEffects, volume: float, loudness: Optional[dict] = None,
+                 start: float = 0, duration: float = 0) -> str:
+    """The FFmpeg -af chain for one stream, starting `start` seconds into the track
+
+    Normalization uses a cached measurement for an exact linear gain when
+    there is one, and loudnorm's single-pass dynamic mode otherwise.
+    """
+    filters = []
+    if effects.normalize:
+        target = f"I={LOUDNESS_TARGET:g}:TP={LOUDNESS_PEAK:g}:LRA={LOUDNESS_RANGE:g}"
+        if loudness:
+            target += (
+                f":measured_I={loudness['input_i']}:measured_TP={loudness['input_tp']}"
+                f":measured_LRA={loudness['input_lra']}:measured_thresh={loudness['input_thresh']}"
+                f":offset={loudness['target_offset']}:linear=true"
+            )
+        # loudnorm works at 192kHz internally
+        filters += [f"loudnorm={target}", f"aresample={SAMPLE_RATE}"]
+    for frequency, gain in EQ_PRESETS[effects.eq]:
+        filters.append(f"equalizer=f={frequency}:t=o:w=1:g={gain}")
+    if effects.bass:
+        filters.append(f"bass=g={effects.bass}:f=110:w=0.6")
+    if effects.eq != 'flat' or effects.bass:
+        filters.append("alimiter=limit=0.9:level=false")
+    # Fades sit before any speed change, so their times are in track seconds
+    if effects.crossfade:
+        if start < effects.crossfade:
+            filters.append(f"afade=t=in:st=0:d={effects.crossfade - start:g}")
+        if duration > effects.crossfade * 2:
+            fade_at = max(0, duration - effects.crossfade - start)
+            filters.append(f"afade=t=out:st={fade_at:g}:d={effects.crossfade:g}")
+    if effects.speed != 1.0:
+        if effects.pitch:
+            filters.append(f"aresample={SAMPLE_RATE},asetrate={SAMPLE_RATE * effects.speed:g},aresample={SAMPLE_RATE}")
+        else:
+            filters.append(f"atempo={effects.speed:g}")
+    if volume != 1.0:
+        filters.append(f"volume={volume:g}")
+    return ','.join(filters)
+
+class LoudnessCache:
+    """Measured loudness per track, so normalization can apply one exact gain
+
+    Tracks are measured in the background by a separate FFmpeg pass the
+    first time they play with normalization on.
+    """
+    def __init__(self, path: str = LOUDNESS_CACHE_PATH, measurements: int = LOUDNESS_MEASUREMENTS):
+        self.path = path
+        self._measurements = measurements
+        self._semaphore = None  # (loop, Semaphore); rebuilt for each loop that measures tracks
+        self._measuring = set()
+        self._lock = threading.Lock()
+        self._db = None  # Opened on first use; most guilds never normalize
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS loudness (
+                    key TEXT PRIMARY KEY,
+                    stats TEXT NOT NULL,
+                    measured_at REAL NOT NULL
+                )
+            ''')
+            self._db.commit()
+        return self._db
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self.db.execute('SELECT stats FROM loudness WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def measure_later(self, key: str, location: str, duration: float, cached: bool = False) -> None:
+        """Start measuring a track unless it is known, in progress or too long"""
+        if key in self._measuring or (duration or 0) > LOUDNESS_MAX_SECONDS or self.get(key):
+            return
+        self._measuring.add(key)
+        asyncio.get_running_loop().create_task(self._measure(key, location, cached))
+
+    def _measurement_slots(self) -> asyncio.Semaphore:
+        """The running loop's measurement semaphore; one made on an earlier loop can't be awaited here"""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = (loop, asyncio.Semaphore(self._measurements))
+        return self._semaphore[1]
+
+    async def _measure(self, key: str, location: str, cached: bool) -> None:
+        reconnect = [] if cached else ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+        try:
+            async with self._measurement_slots():
+                with metrics.loudness_measure_seconds.time():
+                    process = await asyncio.create_subprocess_exec(
+                        'ffmpeg', '-nostdin', '-hide_banner', '-nostats', *reconnect,
+                        '-i', location, '-vn', '-map', '0:a:0',
+                        '-af', f"loudnorm=I={LOUDNESS_TARGET:g}:TP={LOUDNESS_PEAK:g}:LRA={LOUDNESS_RANGE:g}"
+                               ":print_format=json",
+                        '-f', 'null', '-',
+                        stdout=asyncio.subprocess.DEVNULL,
+                        stderr=asyncio.subprocess.PIPE
+                    )
+                    _, stderr = await process.communicate()
+            output = stderr.decode(errors='replace')
+            # loudnorm prints its summary as the last JSON object on stderr
+            match = re.search(r'\{[^{}]*"input_i"[^{}]*\}', output)
+            if process.returncode != 0 or not match:
+                raise Exception(output.strip().splitlines()[-1] if output.strip() else f"ffmpeg exited with {process.returncode}")
+            stats = json.loads(match.group(0))
+            if stats['input_i'] in ('-inf', 'inf'):
+                return  # Silent track; nothing to normalize against
+            with self._lock:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO loudness VALUES (?, ?, ?)', (key, json.dumps(stats), time.time())
+                )
+                self.db.commit()
+        except Exception as e:
+            print(f"Error measuring loudness for {key}: {e}")
+        finally:
+            self._measuring.discard(key)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+loudness_cache = LoudnessCache()
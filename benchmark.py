@@ -0,0 +1,500 @@
+"""Offline load test for MusicCog
+
+Drives real bot commands against local fakes for yt-dlp, Spotify, Genius,
+FFmpeg and the Discord voice client, so performance can be measured without
+network access or a bot token:
+
+    python benchmark.py --guilds 1 10 100 1000
+
+Each simulated guild plays a search, imports a Spotify playlist, lists the
+queue, fetches lyrics, skips once, lets one song hand over naturally and
+stops. Fake voice clients consume 20ms frames in real time on their own
+threads, like discord.py's audio player. Every run uses fresh SQLite stores
+in a temporary directory.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import ytdl_source
+from music_cog import MusicCog
+from queue_manager import QueueManager, QueuedSong, SongQueue
+
+FRAME_SECONDS = 0.02
+# One 20ms frame of 48kHz stereo 16-bit silence
+SILENCE = b'\x00' * 3840
+
+def _hash(text):
+    return zlib.crc32(text.encode())
+
+class FakeCatalog:
+    """Deterministic songs shared by the fake YouTube, Spotify and Genius"""
+    def __init__(self, track_seconds):
+        self.track_seconds = track_seconds
+        self.videos = {}  # video ID -> (title, duration)
+
+    def duration(self, name):
+        return self.track_seconds + _hash(name) % max(1, self.track_seconds // 5)
+
+    def video_id(self, text):
+        return f"v{_hash(text):010d}"
+
+    def add_video(self, text, title, duration):
+        video_id = self.video_id(text)
+        self.videos[video_id] = (title, duration)
+        return video_id
+
+class FakeYoutubeDL:
+    """Stands in for the shared YoutubeDL with a fixed per-call latency"""
+    def __init__(self, catalog, latency):
+        self.catalog = catalog
+        self.latency = latency
+        self.calls = 0
+
+    def extract_info(self, url, download=False):
+        self.calls += 1
+        time.sleep(self.latency)
+        search = re.match(r'ytsearch(\d*):(.*)', url)
+        if search:
+            return {'_type': 'playlist', 'entries': self._search(search.group(2), int(search.group(1) or 1))}
+        if 'list=' in url:
+            playlist = parse_qs(urlparse(url).query)['list'][0]
+            return {'_type': 'playlist', 'entries': [
+                self._flat(f"{playlist}:{i}", f"Playlist {playlist} track {i}", self.catalog.duration(f"{playlist}:{i}"))
+                for i in range(20)
+            ]}
+        return self._full(parse_qs(urlparse(url).query).get('v', [url])[0])
+
+    def _search(self, query, count):
+        """A music video that runs long, then the Topic upload, then filler"""
+        duration = self.catalog.duration(query)
+        entries = [
+            self._flat(f"{query}#video", f"{query} (Official Video)", duration + 60, channel='Some Label'),
+            self._flat(f"{query}#topic", query.split(' - ')[-1], duration, channel=f"{query.split(' - ')[0]} - Topic"),
+        ]
+        entries += [
+            self._flat(f"{query}#{i}", f"{query} (Live {i})", duration + 30 * i, channel='Fan Uploads')
+            for i in range(2, count)
+        ]
+        return entries[:count]
+
+    def _flat(self, key, title, duration, channel='Uploader'):
+        video_id = self.catalog.add_video(key, title, duration)
+        return {
+            '_type': 'url', 'id': video_id, 'url': f"https://www.youtube.com/watch?v={video_id}",
+            'title': title, 'duration': duration, 'channel': channel
+        }
+
+    def _full(self, video_id):
+        title, duration = self.catalog.videos.get(video_id, (f"Video {video_id}", self.catalog.duration(video_id)))
+        return {
+            'title': title,
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'url': f"fake://{video_id}?expire={int(time.time()) + 21600}&duration={duration}",
+            'duration': duration,
+            'acodec': 'opus'
+        }
+
+class FakeSpotify:
+    """Stands in for `spotipy.Spotify`; playlists hold catalog tracks"""
+    latency = 0.0
+    catalog = None
+    playlist_size = 10
+
+    def __init__(self, auth_manager=None):
+        pass
+
+    def _track(self, track_id):
+        artist, title = f"Artist {_hash(track_id) % 97}", f"Song {track_id}"
+        return {
+            'id': track_id, 'name': title, 'artists': [{'name': artist}],
+            'external_ids': {'isrc': f"QZ{_hash(track_id) % 10 ** 10:010d}"},
+            'duration_ms': self.catalog.duration(f"{artist} - {title}") * 1000
+        }
+
+    def tracks(self, track_ids):
+        time.sleep(self.latency)
+        return {'tracks': [self._track(track_id) for track_id in track_ids]}
+
+    def playlist_items(self, playlist_id, additional_types=None, fields=None):
+        time.sleep(self.latency)
+        return {
+            'items': [{'track': self._track(f"{playlist_id}t{i}")} for i in range(self.playlist_size)],
+            'next': None
+        }
+
+    def album_tracks(self, album_id, limit=50):
+        time.sleep(self.latency)
+        return {'items': [{'id': f"{album_id}t{i}"} for i in range(self.playlist_size)], 'next': None}
+
+    def artist_top_tracks(self, artist_id):
+        time.sleep(self.latency)
+        return {'tracks': [self._track(f"{artist_id}t{i}") for i in range(10)]}
+
+    def next(self, results):
+        return None
+
+class FakeGenius:
+    """Stands in for `lyricsgenius.Genius`"""
+    latency = 0.0
+
+    def __init__(self, token=None):
+        pass
+
+    def search_song(self, title, artist=''):
+        time.sleep(self.latency)
+        return SimpleNamespace(title=title, artist=artist or 'Unknown', lyrics="la la la\n" * 40)
+
+class FakeAudio:
+    """Stands in for an FFmpeg process, producing silent frames for the track length"""
+    def __init__(self, location, **kwargs):
+        query = parse_qs(urlparse(location).query)
+        self.frames = int(float(query.get('duration', ['1'])[0]) / FRAME_SECONDS)
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return SILENCE
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.frames = 0
+
+class FakeVoiceClient:
+    """Consumes frames in real time on its own thread, like discord.py's AudioPlayer"""
+    def __init__(self, guild, channel, loop):
+        self.guild = guild
+        self.channel = channel
+        self.loop = loop
+        self.source = None
+        self.starts = asyncio.Queue()  # (first frame time, gap since the previous song, ended how)
+        self._thread = None
+        self._stopped = None
+        self._paused = threading.Event()
+        self._ended = None  # (time, 'skip' or 'natural') of the previous song
+        self._connected = True
+
+    def play(self, source, *, after=None):
+        self.source = source
+        self._stopped = threading.Event()
+        self._paused.clear()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._stopped), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stopped):
+        first = True
+        next_tick = time.perf_counter()
+        while not stopped.is_set():
+            if self._paused.is_set():
+                time.sleep(FRAME_SECONDS)
+                next_tick = time.perf_counter()
+                continue
+            data = source.read()
+            if not data:
+                break
+            if first:
+                first = False
+                now = time.perf_counter()
+                gap = (now - self._ended[0], self._ended[1]) if self._ended else (None, None)
+                self.loop.call_soon_threadsafe(self.starts.put_nowait, (now,) + gap)
+            next_tick += FRAME_SECONDS
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self._ended = (time.perf_counter(), 'skip' if stopped.is_set() else 'natural')
+        source.cleanup()
+        if self.source is source:
+            self.source = None
+        if after:
+            after(None)
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self.source is not None and not self._paused.is_set()
+
+    def is_paused(self):
+        return self.source is not None and self._paused.is_set()
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    def stop(self):
+        if self._stopped:
+            self._stopped.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        # Like discord.py, this doesn't wait for the audio thread to run its after callback
+        self._connected = False
+        self.stop()
+        self.guild.voice_client = None
+
+class FakeChannel:
+    def __init__(self, guild):
+        self.guild = guild
+
+    def permissions_for(self, member):
+        return SimpleNamespace(connect=True, speak=True)
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self, asyncio.get_running_loop())
+        return self.guild.voice_client
+
+class FakeMessage:
+    async def edit(self, *, content=None, embed=None):
+        pass
+
+class FakeContext:
+    """Just enough of commands.Context for MusicCog's commands"""
+    def __init__(self, guild_id):
+        self.guild = SimpleNamespace(id=guild_id, me=None, voice_client=None)
+        self.author = SimpleNamespace(id=guild_id, voice=SimpleNamespace(channel=FakeChannel(self.guild)))
+        self.message = SimpleNamespace(author=self.author)
+        self.sent = []
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, *, embed=None):
+        self.sent.append(content if content is not None else embed)
+        return FakeMessage()
+
+    def typing(self):
+        return _NoTyping()
+
+class _NoTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+def install_fakes(args):
+    """Swap every external service for its fake"""
+    catalog = FakeCatalog(args.track_seconds)
+    fake_ytdl = FakeYoutubeDL(catalog, args.ytdl_latency)
+    # Clients are built lazily, so the fakes take their place before first use
+    ytdl_source._ytdl = fake_ytdl
+    ytdl_source.create_ffmpeg_source = FakeAudio
+    FakeSpotify.latency, FakeSpotify.catalog = args.spotify_latency, catalog
+    FakeGenius.latency = args.genius_latency
+    return fake_ytdl
+
+def make_cog():
+    """A MusicCog whose Spotify and Genius clients are the fakes"""
+    cog = MusicCog(SimpleNamespace(loop=asyncio.get_running_loop()))
+    cog.spotify_service._client = FakeSpotify()
+    cog.lyrics_service._genius = FakeGenius()
+    return cog
+
+def rss_bytes():
+    """Current resident set size, falling back to the peak where /proc is missing"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def monitor_lag(samples, interval=0.01):
+    """Record how late the event loop wakes up from short sleeps"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+class GuildRun:
+    """One simulated guild's command script and its measurements"""
+    def __init__(self, cog, guild_id, timeout):
+        self.cog = cog
+        self.ctx = FakeContext(guild_id)
+        self.timeout = timeout
+        self.commands = 0
+        self.errors = []  # Error messages sent back to the user
+        self.first_audio = None
+        self.gaps = []  # (seconds, 'skip' or 'natural')
+
+    async def command(self, command, *args, **kwargs):
+        self.commands += 1
+        sent = len(self.ctx.sent)
+        # The cog is never added to a bot, so call the command's function directly
+        await command.callback(self.cog, self.ctx, *args, **kwargs)
+        self.errors += [m for m in self.ctx.sent[sent:] if isinstance(m, str) and m.startswith('❌')]
+
+    async def next_start(self):
+        started, gap, how = await asyncio.wait_for(self.ctx.voice_client.starts.get(), self.timeout)
+        if gap is not None:
+            self.gaps.append((gap, how))
+        return started
+
+    async def run(self, loaded):
+        guild_id = self.ctx.guild.id
+        issued = time.perf_counter()
+        await self.command(self.cog.play, query=f"Guild {guild_id} Artist - Opening Song")
+        if self.ctx.voice_client is None:
+            _mark(loaded)
+            return
+        self.first_audio = await self.next_start() - issued
+
+        await self.command(self.cog.play, query=f"https://open.spotify.com/playlist/pl{guild_id % 10}")
+        _mark(loaded)
+        await self.command(self.cog.queue)
+        await self.command(self.cog.lyrics)
+        await self.command(self.cog.skip)
+        await self.next_start()
+        # The song after this one is prepared while it plays, then handed over
+        await self.next_start()
+        await self.command(self.cog.stop)
+
+def _mark(future):
+    if not future.done():
+        future.set_result(None)
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def run_guilds(args, count):
+    """Run the command script for `count` guilds at once"""
+    cog = make_cog()
+    await cog.cog_load()
+    lag = []
+    lag_task = asyncio.get_running_loop().create_task(monitor_lag(lag))
+
+    baseline = rss_bytes()
+    runs = [GuildRun(cog, 10 ** 6 + i, args.timeout) for i in range(count)]
+    loaded = [asyncio.get_running_loop().create_future() for _ in runs]
+    peak = {}
+
+    async def checkpoint():
+        # Measure memory once every guild is playing with its playlist queued
+        await asyncio.gather(*loaded)
+        peak['rss'] = rss_bytes()
+
+    async def start(i, run):
+        await asyncio.sleep(args.ramp * i / count)
+        try:
+            await run.run(loaded[i])
+        except Exception as e:
+            run.errors.append(repr(e))
+            _mark(loaded[i])
+            print(f"Guild {run.ctx.guild.id} failed: {e!r}", file=sys.stderr)
+
+    started = time.perf_counter()
+    checkpoint_task = asyncio.get_running_loop().create_task(checkpoint())
+    await asyncio.gather(*(start(i, run) for i, run in enumerate(runs)))
+    wall = time.perf_counter() - started
+    await checkpoint_task
+    lag_task.cancel()
+
+    cog.cog_unload()
+    # Destroyed first, so audio threads finishing after the loop closes find nothing to post to
+    for player in list(cog.players.values()):
+        player.destroy()
+    for run in runs:
+        if run.ctx.voice_client:
+            await run.ctx.voice_client.disconnect()
+
+    first_audio = [run.first_audio for run in runs if run.first_audio is not None]
+    return {
+        'guilds': count,
+        'commands': sum(run.commands for run in runs),
+        'errors': collections.Counter(error for run in runs for error in run.errors),
+        'wall': wall,
+        'first_audio': first_audio,
+        'skip_gaps': [gap for run in runs for gap, how in run.gaps if how == 'skip'],
+        'natural_gaps': [gap for run in runs for gap, how in run.gaps if how == 'natural'],
+        'lag': lag,
+        'memory_per_guild': (peak.get('rss', baseline) - baseline) / count,
+    }
+
+async def run_restore(count, songs=20):
+    """Time opening the store and restoring `count` guilds' saved queues"""
+    store = QueueManager()
+    for i in range(count):
+        queue = SongQueue(
+            (QueuedSong(title=f"Song {i}-{n}", url=f"https://www.youtube.com/watch?v=r{i:06d}{n:04d}",
+                        duration=180, artist='Artist'), None)
+            for n in range(songs)
+        )
+        store.save_queue(10 ** 6 + i, None, queue.take_changes())
+    store.close()
+    started = time.perf_counter()
+    cog = make_cog()
+    opened = time.perf_counter()
+    await cog.cog_load()
+    restored = time.perf_counter()
+    assert len(cog.players) == count
+    cog.cog_unload()
+    return opened - started, restored - opened
+
+def report(result, restore):
+    def ms(values, fraction):
+        return percentile(values, fraction) * 1000
+
+    print(f"\n== {result['guilds']} guild(s) ==")
+    print(f"commands      {result['commands']} in {result['wall']:.1f}s "
+          f"({result['commands'] / result['wall']:.1f}/s), {sum(result['errors'].values())} errors")
+    for error, count in result['errors'].most_common(3):
+        print(f"  {count} x {error}")
+    for name in ('first_audio', 'skip_gaps', 'natural_gaps', 'lag'):
+        values = result[name]
+        print(f"{name:<13} p50 {ms(values, 0.5):8.1f}ms  p95 {ms(values, 0.95):8.1f}ms  "
+              f"max {max(values, default=float('nan')) * 1000:8.1f}ms  (n={len(values)})")
+    print(f"memory        {result['memory_per_guild'] / 1024:.1f} KiB per guild (RSS)")
+    print(f"restore       open {restore[0] * 1000:.1f}ms, load {restore[1] * 1000:.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--track-seconds', type=int, default=12, help="Length of fake songs")
+    parser.add_argument('--ytdl-latency', type=float, default=0.3)
+    parser.add_argument('--spotify-latency', type=float, default=0.1)
+    parser.add_argument('--genius-latency', type=float, default=0.2)
+    parser.add_argument('--ramp', type=float, default=1.0, help="Seconds over which guilds start")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Seconds to wait for a song to start")
+    args = parser.parse_args()
+
+    fake_ytdl = install_fakes(args)
+    home = os.getcwd()
+    for count in args.guilds:
+        # Fresh stores per run, so caches start cold
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                os.mkdir(os.path.join(directory, 'load'))
+                os.chdir(os.path.join(directory, 'load'))
+                calls = fake_ytdl.calls
+                result = asyncio.run(run_guilds(args, count))
+                os.mkdir(os.path.join(directory, 'restore'))
+                os.chdir(os.path.join(directory, 'restore'))
+                restore = asyncio.run(run_restore(count))
+            finally:
+                os.chdir(home)
+        report(result, restore)
+        print(f"extractions   {fake_ytdl.calls - calls}")
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,42 @@
 import os
+import time
 from dotenv import load_dotenv
 
+_started = time.perf_counter()
+
 # Load environment variables before any other imports that might use them
 load_dotenv()
 
+# Print how long each startup phase took
+STARTUP_PROFILE = os.getenv('STARTUP_PROFILE', '').lower() in ('1', 'true', 'yes')
+
+def startup_mark(phase):
+    if STARTUP_PROFILE:
+        print(f"[startup] {phase}: {(time.perf_counter() - _started) * 1000:.0f}ms")
+
 import discord
 from discord.ext import commands
+import metrics
 from music_cog import MusicCog
 
+startup_mark("imports done")
+
 # Bot setup with required intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Sharding: set by supervisor.py, or by hand to run shards in one process
+SHARD_COUNT = int(os.getenv('SHARD_COUNT') or 0)
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()]
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix='!', intents=intents,
+        shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None
+    )
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
 
 # Remove default help command to create our own
 bot.remove_command('help')
@@ -31,14 +54,22 @@ async def help(ctx):
     music_commands = {
         "play <query/URL>": "Play a song from YouTube/Spotify or search query",
         "pause": "Pause the current song",
-        "resume": "Resume playback",
+        "resume": "Resume playback or start a restored queue",
         "stop": "Stop playback and clear queue",
+        "cancel": "Stop a running playlist import",
         "skip": "Skip to the next song",
-        "queue": "Show the current song queue",
+        "queue [page]": "Show the current song queue",
+        "remove <position>": "Remove a song from the queue",
+        "move <from> <to>": "Move a song within the queue",
+        "shuffle": "Shuffle the queue",
         "nowplaying (np)": "Show details about the current song",
+        "seek <time>": "Jump to a time in the current song (1:30, +15, -10)",
         "volume <0-100>": "Adjust the playback volume",
         "loop [mode]": "Set loop mode (off/track/queue)",
-        "lyrics": "Show lyrics for the current song"
+        "autoplay [on/off]": "Play related songs when the queue runs out",
+        "fx [effect] [value]": "Audio effects: normalize, eq, bass, speed, crossfade",
+        "lyrics": "Show lyrics for the current song",
+        "stats": "Show bot statistics (administrators)"
     }
 
     # Add fields for each command
@@ -54,14 +85,21 @@ async def help(ctx):
 
     await ctx.send(embed=embed)
 
+@bot.event
+async def setup_hook():
+    """Register the cog (and restore saved queues) before connecting to the gateway"""
+    await bot.add_cog(MusicCog(bot))
+    startup_mark("cog loaded")
+
 @bot.event
 async def on_ready():
+    startup_mark("gateway ready")
     print(f'{bot.user} is ready!')
-    await bot.add_cog(MusicCog(bot))
 
 @bot.event
 async def on_command_error(ctx, error):
     """Global error handler"""
+    metrics.command_errors_total.inc()
     if isinstance(error, commands.CommandNotFound):
         await ctx.send("❌ Command not found. Use !help to see available commands.")
     elif isinstance(error, commands.MissingPermissions):
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+class ExecutorBusy(Exception):
+    """Raised when a pool already has its maximum amount of work queued"""
+
+class ExecutorTimeout(Exception):
+    """Raised when a blocking call takes longer than the pool allows"""
+
+class BoundedExecutor:
+    """Named thread pool with a queue-depth limit and per-call timeouts
+
+    Awaiting `run` can be cancelled: work that has not started yet is
+    dropped from the pool's queue, and the result of work already running
+    in a thread is discarded.
+    """
+    def __init__(self, name: str, workers: int, max_pending: int, timeout: float):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._pool = None  # Started on first use, and again after a shutdown
+        pools[name] = self
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{self.name}-worker")
+        return self._pool
+
+    async def run(self, func, *args, timeout: float = None):
+        """Run a blocking call on this pool without blocking the event loop"""
+        if self.pending >= self.max_pending:
+            metrics.executor_rejected_total.inc(pool=self.name, reason='busy')
+            raise ExecutorBusy(f"Too many {self.name} requests in progress, try again shortly")
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            metrics.executor_wait_seconds.observe(started - submitted, pool=self.name)
+            try:
+                return func(*args)
+            finally:
+                metrics.executor_call_seconds.observe(time.perf_counter() - started, pool=self.name)
+
+        self.pending += 1
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self._executor(), timed), timeout)
+        except asyncio.TimeoutError:
+            metrics.executor_rejected_total.inc(pool=self.name, reason='timeout')
+            raise ExecutorTimeout(f"{self.name.capitalize()} request timed out after {timeout:g}s")
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        """Let the pool's threads exit once their current call returns; the next call starts a new pool"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+# Every pool by name, read by the pending gauge at scrape time
+pools = {}
+
+metrics.Gauge(
+    'executor_pending', 'Calls queued or running on a pool', ('pool',),
+    collect=lambda: {(name,): pool.pending for name, pool in pools.items()}
+)
+
+# yt-dlp searches and stream extraction
+extraction_pool = BoundedExecutor(
+    'extraction',
+    workers=int(os.getenv('EXTRACTION_WORKERS', '4')),
+    max_pending=int(os.getenv('EXTRACTION_MAX_PENDING', '64')),
+    timeout=float(os.getenv('EXTRACTION_TIMEOUT', '30'))
+)
+
+# Spotify API calls
+metadata_pool = BoundedExecutor(
+    'metadata',
+    workers=int(os.getenv('METADATA_WORKERS', '2')),
+    max_pending=int(os.getenv('METADATA_MAX_PENDING', '32')),
+    timeout=float(os.getenv('METADATA_TIMEOUT', '15'))
+)
+
+# Genius lyrics lookups
+lyrics_pool = BoundedExecutor(
+    'lyrics',
+    workers=int(os.getenv('LYRICS_WORKERS', '2')),
+    max_pending=int(os.getenv('LYRICS_MAX_PENDING', '16')),
+    timeout=float(os.getenv('LYRICS_TIMEOUT', '15'))
+)
@@ -0,0 +1,529 @@
+import asyncio
+import time
+import metrics
+from audio_cache import audio_cache
+from audio_effects import AudioEffects, loudness_cache
+from play_history import play_history
+from queue_manager import SongQueue
+from voice_lifecycle import VoiceLifecycle
+from ytdl_source import DEFAULT_VOLUME, YTDLSource
+
+# How many upcoming songs get their stream URL resolved ahead of time
+PREFETCH_DEPTH = 2
+# Seconds before the current song ends to start preparing the next one
+PREBUFFER_LEAD = 10
+# Seconds of audio decoded ahead so the next song starts without a gap
+PREBUFFER_SECONDS = 2
+# Seconds of playback between saves of the current song's position
+POSITION_SAVE_INTERVAL = 15
+# A song stopped more than this many seconds before its end counts as skipped
+SKIP_MARGIN = 10
+# History recommendations considered per autoplay pick
+AUTOPLAY_CANDIDATES = 5
+
+# Player states; only the consumer task moves a player out of STARTING
+IDLE, STARTING, PLAYING = 'idle', 'starting', 'playing'
+
+class GuildPlayer:
+    """Queue, playback state and persistence for a single guild
+
+    Track changes are requests posted to one consumer task on the event
+    loop, which applies them strictly in order. The audio thread only
+    posts a "finished" event; it never touches the queue or the store.
+    """
+    def __init__(self, bot, guild_id, queue_manager, admission, on_destroy=None, on_song_start=None,
+                 saved_state=None):
+        self.bot = bot
+        self.guild_id = guild_id
+        self.queue_manager = queue_manager
+        self.admission = admission  # The cog's extraction capacity, shared by every guild
+        self.on_destroy = on_destroy  # Called with this player on teardown
+        self.on_song_start = on_song_start  # Called with (player, song) once a song starts
+        self.current_player = None
+        self.song_queue = SongQueue()
+        self.volume = DEFAULT_VOLUME  # 50%, or 100% in opus mode so Opus streams pass straight through
+        self.effects = AudioEffects()  # FFmpeg filter settings applied to every stream
+        self.loop_mode = "off"  # off, track, queue
+        self.autoplay = False  # Keep playing related songs from the play history once the queue runs dry
+        self.current_ctx = None  # Store context for looping
+        self.state = IDLE
+        self.destroyed = False  # Set by destroy(); late audio-thread callbacks are dropped after it
+        self._resolving = {}  # id(song) -> in-flight resolve task
+        self._prepared = None  # (song, player) opened and buffered ahead of time
+        self._events = asyncio.Queue()  # (kind, ctx, finished player, posted at) for the consumer
+        self._consumer = None  # Task draining _events, started on first use
+        self._start_task = None  # The in-flight _play_song, cancellable by skip/stop
+        self._start_requested = None  # (perf_counter, was a song playing) when the last start was asked for
+        self.importing = None  # Task running a playlist import, cancelled by !cancel and !stop
+        self.lookups = set()  # Tasks finding the song for a !play, cancelled by !stop
+        self._last_play = None  # (song, play history id) for the song playing or last played
+        self._autoplay_song = None  # Picked and resolving ahead of time, played if the queue runs dry
+        self._autoplaying = None  # The song autoplay started, which has no requester
+        self._autoplay_failed = set()  # Video IDs autoplay picked that would not start
+        self.voice = VoiceLifecycle(self)
+        self._load_saved_queue(saved_state)
+
+    def _load_saved_queue(self, saved_state):
+        """Restore this guild's saved queue (loaded once at startup), in order, as unresolved descriptors"""
+        if saved_state is None:
+            return
+        current_song, queue = saved_state
+        # Kept as loaded, so its entries keep their stored sequence numbers and nothing is rewritten
+        self.song_queue = queue
+        # The interrupted song goes back to the front and resolves when played
+        if current_song:
+            self.song_queue.appendleft((current_song, None))
+
+    def has_restored_queue(self):
+        """True when songs are queued but nothing is playing (e.g. after a restart)"""
+        return bool(self.song_queue) and self.state == IDLE
+
+    def is_idle(self):
+        """True when nothing is playing, starting or queued"""
+        return self.state == IDLE and not self.song_queue
+
+    def clear(self):
+        """Drop the queue, the current song, any prepared stream, a running import and pending lookups"""
+        self.cancel_import()
+        self.cancel_lookups()
+        self.song_queue.clear()
+        self._autoplay_song = None
+        self._cancel_pending()
+        self._discard_prepared()
+        self.current_player = None
+        self.current_ctx = None
+
+    def destroy(self):
+        """Release buffered streams and in-flight work, then unregister"""
+        self.destroyed = True
+        self.cancel_import()
+        self.cancel_lookups()
+        self._cancel_pending()
+        self._discard_prepared()
+        self.voice.close()
+        if self._consumer:
+            self._consumer.cancel()
+            self._consumer = None
+        if self.on_destroy:
+            self.on_destroy(self)
+
+    def _cancel_pending(self):
+        """Abandon a song that is still starting and every queued extraction"""
+        if self._start_task:
+            self._start_task.cancel()
+        self.state = IDLE
+        for task in list(self._resolving.values()):
+            task.cancel()
+
+    def suspend(self):
+        """Stop playback but keep the session: the current song goes back to the head of the queue at its position"""
+        playing, ctx = self.current_player, self.current_ctx
+        self._cancel_pending()
+        self._discard_prepared()
+        self.current_player = None
+        if playing is None:
+            return
+        # A song that had already reached its end is not worth resuming
+        if not playing.duration or playing.position < playing.duration - 1:
+            playing.song.start = playing.position
+            self.song_queue.appendleft((playing.song, ctx))
+        self.save_state()
+
+    def interrupted_ctx(self):
+        """The ctx of the song waiting to resume mid-play, if there is one"""
+        if self.song_queue and self.song_queue[0][0].start:
+            return self.song_queue[0][1]
+        return None
+
+    def skip(self, ctx):
+        """Skip the current song, or abandon the one still being resolved"""
+        if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
+            ctx.voice_client.stop()  # The after callback posts a "finished" event
+            return True
+        if self.state == STARTING and self._start_task:
+            # Still STARTING, so the consumer moves on to the next song
+            self._start_task.cancel()
+            self._post('advance', ctx)
+            return True
+        return False
+
+    def _post(self, kind, ctx, player=None, posted_at=None):
+        """Queue a track change for the consumer task (event loop only)"""
+        if self.destroyed:
+            return  # Would start a consumer on a player nothing references any more
+        if self._consumer is None:
+            self._consumer = self.bot.loop.create_task(self._consume())
+        self._events.put_nowait((kind, ctx, player, posted_at or time.perf_counter()))
+
+    def _song_finished(self, ctx, player):
+        """after= callback from the audio thread: hand the event to the loop and return"""
+        # discord.py's disconnect() doesn't wait for the audio thread, so this can fire after destroy()
+        if self.destroyed:
+            return
+        self.bot.loop.call_soon_threadsafe(self._post, 'finished', ctx, player, time.perf_counter())
+
+    async def _consume(self):
+        """Apply track changes one at a time, in the order they were posted"""
+        while True:
+            kind, ctx, player, posted_at = await self._events.get()
+            if kind == 'finished':
+                # Ignore players that were stopped by clear() or already replaced
+                if player is not self.current_player or self.state != PLAYING:
+                    continue
+                if not (ctx.voice_client and ctx.voice_client.is_connected()):
+                    # Voice dropped mid-song; keep the session for the reconnect
+                    self.suspend()
+                    continue
+                self._record_finish(player)
+            elif self.state != STARTING:
+                continue  # The start was abandoned by clear() before we got here
+            try:
+                await self._advance(ctx, posted_at)
+            except Exception as e:
+                print(f"Error advancing the queue in guild {self.guild_id}: {e}")
+                self.state = IDLE
+
+    async def _advance(self, ctx, requested_at):
+        """Start the next song, moving past any that fail to start"""
+        while ctx.voice_client:
+            song, song_ctx, announce = self._next_song(ctx)
+            if song is None:
+                break
+            self.state = STARTING
+            self._start_requested = (requested_at, self.current_player is not None)
+            self._start_task = self.bot.loop.create_task(self._play_song(song_ctx, song, announce))
+            await asyncio.wait({self._start_task})
+            task, self._start_task = self._start_task, None
+            if task.cancelled() or task.result():
+                # Playing, or abandoned by skip/clear, which decide what happens next
+                return
+            requested_at = time.perf_counter()
+
+        # No more songs in queue, disconnect after a delay
+        self.state = IDLE
+        self.current_player = None
+        self.current_ctx = None
+        # Otherwise the finished song stays saved as current and comes back after a restart
+        self.save_state()
+        if ctx.voice_client:
+            self.voice.schedule_idle(ctx)
+
+    def _next_song(self, ctx):
+        """Take the next song per the loop mode, as (song, ctx, announcement)"""
+        if self.loop_mode == "track" and self.current_player:
+            # Replay the current track with a fresh stream
+            return self.current_player.song, self.current_ctx, 'Looping track'
+
+        # If queue loop is enabled, add the finished song back to the end
+        if self.loop_mode == "queue" and self.current_player:
+            self.song_queue.append((self.current_player.song, self.current_ctx))
+
+        if self.song_queue:
+            next_song, next_ctx = self.song_queue.popleft()
+            return next_song, next_ctx or ctx, 'Now playing'
+
+        if self.autoplay and self.loop_mode == "off":
+            song = self._autoplay_song or self._pick_autoplay()
+            self._autoplay_song = None
+            if song:
+                self._autoplaying = song
+                return song, self.current_ctx or ctx, 'Autoplaying'
+        return None, None, None
+
+    def save_state(self):
+        """Save the queue edits since the last save, and the current song with how far into it we are"""
+        current_song = self.current_player.song if self.current_player else None
+        offset = self.current_player.position if self.current_player else 0.0
+        self.queue_manager.save_queue(self.guild_id, current_song, self.song_queue.take_changes(), offset)
+
+    def _save_position(self, player):
+        """Checkpoint the playing song's position so a crash resumes near it"""
+        if player is self.current_player:
+            self.queue_manager.save_position(self.guild_id, player.position)
+
+    async def seek(self, seconds):
+        """Restart the current song's FFmpeg `seconds` in, re-resolving an expired stream first"""
+        playing = self.current_player
+        if not playing.cached and not playing.song.is_resolved():
+            await self.resolve(playing.song)
+        if playing is not self.current_player:
+            return  # Skipped while the stream was resolving
+        playing.seek(seconds, url=None if playing.cached else playing.song.stream_url)
+        self._save_position(playing)
+
+    def queue_changed(self):
+        """Persist and re-prefetch after the queue was edited out of order"""
+        self.save_state()
+        self._prefetch_upcoming()
+
+    def resolve(self, song):
+        """Resolve a song's stream URL, sharing any resolve already in flight"""
+        task = self._resolving.get(id(song))
+        if task is None:
+            task = self.bot.loop.create_task(self._resolve(song))
+            self._resolving[id(song)] = task
+            task.add_done_callback(lambda t: self._resolve_done(song, t))
+        return task
+
+    async def _resolve(self, song):
+        """Resolve within this guild's share of extraction capacity"""
+        if song.is_resolved():
+            return song
+        async with self.admission.slot(self.guild_id):
+            return await YTDLSource.resolve(song)
+
+    def _resolve_done(self, song, task):
+        """Forget a finished resolve; prefetch failures are retried at play time"""
+        self._resolving.pop(id(song), None)
+        if not task.cancelled() and task.exception():
+            print(f"Error resolving {song.title}: {task.exception()}")
+
+    def _prefetch_upcoming(self):
+        """Resolve stream URLs for the songs closest to the head of the queue"""
+        for song, _ in self.song_queue.head(PREFETCH_DEPTH):
+            if not song.is_resolved() and not audio_cache.lookup(song):
+                self.resolve(song)
+
+    def upcoming_song(self):
+        """The song the consumer will start once the current one ends"""
+        if self.loop_mode == "track" and self.current_player:
+            return self.current_player.song
+        if self.song_queue:
+            return self.song_queue[0][0]
+        if self.loop_mode == "queue" and self.current_player:
+            return self.current_player.song
+        if self.autoplay:
+            return self._autoplay_song
+        return None
+
+    def _on_near_end(self, ctx):
+        """Audio-thread hook fired PREBUFFER_LEAD seconds before a song ends"""
+        asyncio.run_coroutine_threadsafe(self._prepare_next(ctx), self.bot.loop)
+
+    async def _prepare_next(self, ctx):
+        """Open and pre-buffer the upcoming song so the hand-off is gapless"""
+        song = self.upcoming_song()
+        if song is None or (self._prepared and self._prepared[0] is song):
+            return
+        self._discard_prepared()
+
+        playing = self.current_player
+        try:
+            if not audio_cache.lookup(song):
+                await self.resolve(song)
+            player = await YTDLSource.from_song(song, volume=self.volume, effects=self.effects)
+            await self.bot.loop.run_in_executor(None, player.prebuffer, PREBUFFER_SECONDS)
+        except Exception as e:
+            print(f"Error preparing {song.title}: {e}")
+            return
+
+        # The current song was skipped, or the effects changed, while we were preparing
+        if self.current_player is not playing or player.effects != self.effects:
+            player.cleanup()
+            return
+        self._prepared = (song, player)
+
+    def _take_prepared(self, song):
+        """Return the prepared player for `song`, dropping any stale one"""
+        if self._prepared and self._prepared[0] is song:
+            player = self._prepared[1]
+            self._prepared = None
+            return player
+        self._discard_prepared()
+        return None
+
+    def set_effects(self, effects):
+        """Apply new effect settings to the playing stream at its current position"""
+        self.effects = effects
+        self._discard_prepared()  # Built with the old filter graph
+        playing = self.current_player
+        if playing and playing.effects != effects:
+            playing.effects = effects
+            metrics.effect_swaps_total.inc()
+            self._measure_loudness(playing)
+
+    def _measure_loudness(self, player):
+        """Queue a loudness measurement so later plays of this track normalize exactly"""
+        if self.effects.normalize and player.song:
+            loudness_cache.measure_later(player.song.video_id, player.url, player.duration, player.cached)
+
+    def set_autoplay(self, enabled):
+        """Switch autoplay, picking its next song right away when turned on"""
+        self.autoplay = enabled
+        if enabled:
+            self._prepare_autoplay()
+        else:
+            if self._prepared and self._prepared[0] is self._autoplay_song:
+                self._discard_prepared()
+            self._autoplay_song = None
+
+    def _pick_autoplay(self):
+        """The best history recommendation after the last song, preferring ones in the audio cache"""
+        if self._last_play is None:
+            return None
+        candidates = play_history.recommend(
+            self.guild_id, self._last_play[0].video_id, self.queued_ids() | self._autoplay_failed, AUTOPLAY_CANDIDATES
+        )
+        metrics.autoplay_picks_total.inc(result='picked' if candidates else 'empty')
+        if not candidates:
+            return None
+        return next((song for song in candidates if audio_cache.lookup(song)), candidates[0])
+
+    def _prepare_autoplay(self):
+        """Pick the song autoplay falls back to and resolve its stream while the current one plays"""
+        self._autoplay_song = None
+        if not self.autoplay or self.song_queue or self.loop_mode != "off":
+            return
+        song = self._autoplay_song = self._pick_autoplay()
+        if song and not audio_cache.lookup(song):
+            self.resolve(song)
+
+    def _record_play(self, ctx, song, start):
+        """Log a fresh start in the play history; a resumed song keeps its original entry"""
+        if start and self._last_play and self._last_play[0] is song:
+            return
+        requester = None if song is self._autoplaying else ctx.author.id
+        self._autoplaying = None
+        try:
+            self._last_play = (song, play_history.record_start(self.guild_id, song, requester))
+        except Exception as e:
+            print(f"Error recording play of {song.title}: {e}")
+
+    def _record_finish(self, player):
+        """Log whether the song that just ended played through or was skipped"""
+        if not self._last_play or self._last_play[0] is not player.song:
+            return
+        completed = not player.duration or player.position >= player.duration - SKIP_MARGIN
+        try:
+            play_history.record_finish(self._last_play[1], completed)
+        except Exception as e:
+            print(f"Error recording the end of {player.song.title}: {e}")
+
+    def _take_resume(self, song):
+        """Seconds into `song` to start at, if it was interrupted mid-play"""
+        start, song.start = song.start, 0.0
+        return start
+
+    def _discard_prepared(self):
+        """Close a prepared player that will not be used"""
+        if self._prepared:
+            self._prepared[1].cleanup()
+            self._prepared = None
+
+    async def _play_song(self, ctx, song, announce='Now playing'):
+        """Resolve a song if needed and start it; True once it is playing"""
+        if not ctx.voice_client:
+            self._discard_prepared()
+            return False
+        try:
+            start = self._take_resume(song)
+            if start:
+                announce = f'Resuming at {int(start) // 60}:{int(start) % 60:02d}'
+            player = None if start else self._take_prepared(song)
+            prepared = player is not None
+            if player is None:
+                if not audio_cache.lookup(song):
+                    await self.resolve(song)
+                player = await YTDLSource.from_song(
+                    song, volume=self.volume, start=start, effects=self.effects
+                )
+        except Exception as e:
+            metrics.song_failures_total.inc()
+            if song is self._autoplaying:
+                self._autoplay_failed.add(song.video_id)
+            self.current_player = None
+            await ctx.send(f"❌ Couldn't play {song.title}: {str(e)}")
+            return False
+
+        player.volume = self.volume
+        player.notify_near_end(lambda: self._on_near_end(ctx), PREBUFFER_LEAD)
+        player.notify_every(
+            lambda: self.bot.loop.call_soon_threadsafe(self._save_position, player), POSITION_SAVE_INTERVAL
+        )
+        ctx.voice_client.play(player, after=lambda e: self._song_finished(ctx, player))
+        self._record_start(prepared)
+        self.voice.cancel_timer('idle')
+        self.state = PLAYING
+        self.current_player = player
+        self.current_ctx = ctx
+        self.save_state()
+        audio_cache.record_play(song)
+        self._record_play(ctx, song, start)
+        self._measure_loudness(player)
+        self._prefetch_upcoming()
+        self._prepare_autoplay()
+        if self.on_song_start:
+            self.on_song_start(self, song)
+        await ctx.send(f'{announce}: {player.title}')
+        return True
+
+    def _record_start(self, prepared):
+        """Time the start that just happened as first audio or as a gap between songs"""
+        metrics.songs_started_total.inc()
+        if self._start_requested is None:
+            return
+        requested_at, was_playing = self._start_requested
+        self._start_requested = None
+        elapsed = time.perf_counter() - requested_at
+        if was_playing:
+            metrics.track_gap_seconds.observe(elapsed)
+            metrics.prepared_handoffs_total.inc(result='hit' if prepared else 'miss')
+        else:
+            metrics.time_to_first_audio_seconds.observe(elapsed)
+
+    def enqueue(self, ctx, songs):
+        """Queue song descriptors and start playback if nothing is playing"""
+        songs = list(songs)
+        if not songs:
+            return None
+        if self.state == IDLE:
+            # The first new song plays next, ahead of any restored queue
+            first = songs.pop(0)
+            self.song_queue.appendleft((first, ctx))
+            self.song_queue.extend((song, ctx) for song in songs)
+            self.play_next(ctx)
+        else:
+            first = None
+            self.song_queue.extend((song, ctx) for song in songs)
+            self.save_state()
+            self._prefetch_upcoming()
+        return first
+
+    def queued_ids(self):
+        """Video IDs of the playing and queued songs, for deduplicating imports"""
+        ids = {song.video_id for song, _ in self.song_queue}
+        if self.current_player and self.current_player.song:
+            ids.add(self.current_player.song.video_id)
+        return ids
+
+    def enqueue_new(self, ctx, songs, seen):
+        """Queue the songs whose video ID is not in `seen` as one batch, adding them to it
+
+        The batch is persisted with a single write. Returns how many songs were queued.
+        """
+        fresh = []
+        for song in songs:
+            if song.video_id not in seen:
+                seen.add(song.video_id)
+                fresh.append(song)
+        self.enqueue(ctx, fresh)
+        return len(fresh)
+
+    def cancel_import(self):
+        """Abort a running playlist import; its pending lookups are released as it unwinds"""
+        if self.importing:
+            self.importing.cancel()
+            self.importing = None
+            return True
+        return False
+
+    def cancel_lookups(self):
+        """Abandon every !play still finding its song, so none is queued after a !stop"""
+        for task in list(self.lookups):
+            task.cancel()
+
+    def play_next(self, ctx):
+        """Start the queue if the player is idle; the consumer task does the work"""
+        if self.state == IDLE:
+            self.state = STARTING
+            self._post('advance', ctx)
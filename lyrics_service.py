@@ -0,0 +1,183 @@
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import metrics
+from executors import lyrics_pool
+from search_cache import normalize_query
+
+LYRICS_CACHE_PATH = os.getenv('LYRICS_CACHE_PATH', 'lyrics_cache.db')
+# Lyrics kept before the least recently used ones are evicted
+LYRICS_CACHE_SIZE = int(os.getenv('LYRICS_CACHE_SIZE', '5000'))
+# Seconds before a "no lyrics found" result is looked up again
+LYRICS_MISS_TTL = 24 * 3600
+# Prefetches are skipped once the lyrics pool's queue is this full, leaving the rest for !lyrics
+PREFETCH_MAX_LOAD = 0.5
+# Hits whose last_used times are held in memory before they are written out
+TOUCH_FLUSH_EVERY = 500
+
+# Bracketed or trailing video decorations that confuse Genius searches
+_NOISE = re.compile(
+    r'[\(\[][^\)\]]*\b(official|video|audio|lyrics?|visuali[sz]er|hd|hq|4k|remaster(ed)?|live|'
+    r'explicit|clean|mv|m/v|feat|ft|featuring)\b[^\)\]]*[\)\]]',
+    re.IGNORECASE
+)
+_FEATURING = re.compile(r'\s+(ft\.?|feat\.?|featuring)\s+.*$', re.IGNORECASE)
+
+def split_title(title: str) -> Tuple[str, str]:
+    """Split a video title into (artist, song), dropping video decorations"""
+    title = _NOISE.sub('', title)
+    title = title.split('|')[0]
+    title = title.replace('"', '').replace('“', '').replace('”', '')
+    if ' - ' in title:
+        artist, song = title.split(' - ', 1)
+    else:
+        artist, song = '', title
+    song = _FEATURING.sub('', song)
+    return ' '.join(artist.split()), ' '.join(song.split())
+
+@dataclass
+class Lyrics:
+    title: str
+    artist: str
+    lyrics: str
+
+class LyricsService:
+    """Genius lookups off the event loop, backed by a persistent cache"""
+    def __init__(self, token: Optional[str] = None, path: str = LYRICS_CACHE_PATH,
+                 max_entries: int = LYRICS_CACHE_SIZE):
+        self.token = token or os.getenv('GENIUS_ACCESS_TOKEN')
+        self._genius = None
+        self._genius_lock = threading.Lock()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._inflight = {}  # cache key -> lookup task
+        self._touched = {}  # cache key -> last_used not yet written; saved with the next store
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Commits skip the fsync; a crash can lose recent lookups, never corrupt the cache
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS lyrics (
+                key TEXT PRIMARY KEY,
+                title TEXT,
+                artist TEXT,
+                lyrics TEXT,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS idx_lyrics_last_used ON lyrics (last_used)')
+        self._db.commit()
+
+    @property
+    def genius(self):
+        """The Genius client, imported and built on first use"""
+        if self._genius is None:
+            with self._genius_lock:
+                if self._genius is None:
+                    with metrics.client_init_seconds.time(client='genius'):
+                        import lyricsgenius
+                        self._genius = lyricsgenius.Genius(self.token)
+        return self._genius
+
+    @staticmethod
+    def _key(artist: str, song: str) -> str:
+        return f"{normalize_query(artist)}|{normalize_query(song)}"
+
+    def _cached(self, key: str):
+        """(found, Lyrics or None) from the cache; expired misses count as not found"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT title, artist, lyrics, fetched_at FROM lyrics WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or (row[2] is None and time.time() - row[3] > LYRICS_MISS_TTL):
+                return False, None
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_FLUSH_EVERY:
+                self._flush_touched()
+                self._db.commit()
+        return True, (Lyrics(row[0], row[1], row[2]) if row[2] is not None else None)
+
+    def _store(self, key: str, result: Optional[Lyrics]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?, ?, ?, ?)',
+                (key, result and result.title, result and result.artist, result and result.lyrics, now, now)
+            )
+            self._touched.pop(key, None)
+            self._flush_touched()
+            self._db.execute(
+                '''DELETE FROM lyrics WHERE key IN (
+                    SELECT key FROM lyrics ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )''',
+                (self.max_entries,)
+            )
+            self._db.commit()
+
+    def _flush_touched(self) -> None:
+        """Write batched last_used times, uncommitted (lock held)"""
+        if self._touched:
+            self._db.executemany(
+                'UPDATE lyrics SET last_used = ? WHERE key = ?',
+                [(used, key) for key, used in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def is_cached(self, title: str) -> bool:
+        """Whether a lookup for this title would be answered from the cache"""
+        return self._cached(self._key(*split_title(title)))[0]
+
+    async def get(self, title: str) -> Optional[Lyrics]:
+        """Lyrics for a video title, from the cache or Genius"""
+        return await self._lookup(title, count=True)
+
+    async def _lookup(self, title: str, count: bool) -> Optional[Lyrics]:
+        """Cached or fetched lyrics; only lookups someone asked for count as hits and misses"""
+        artist, song = split_title(title)
+        key = self._key(artist, song)
+        found, result = self._cached(key)
+        if found:
+            if count:
+                self.hits += 1
+            return result
+
+        if count:
+            self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._fetch(key, artist, song))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: str, artist: str, song: str) -> Optional[Lyrics]:
+        found = await lyrics_pool.run(lambda: self.genius.search_song(song, artist))
+        result = Lyrics(found.title, found.artist, found.lyrics) if found else None
+        self._store(key, result)
+        return result
+
+    def prefetch(self, title: str) -> None:
+        """Warm the cache for a title in the background, unless the lyrics pool is busy"""
+        if lyrics_pool.pending >= lyrics_pool.max_pending * PREFETCH_MAX_LOAD:
+            return
+        async def warm():
+            try:
+                await self._lookup(title, count=False)
+            except Exception as e:
+                print(f"Error prefetching lyrics for {title}: {e}")
+        asyncio.get_running_loop().create_task(warm())
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._db.commit()
+            self._db.close()
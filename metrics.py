@@ -0,0 +1,227 @@
+import asyncio
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+# Local port for the Prometheus text endpoint; leave unset to disable it
+METRICS_PORT = int(os.getenv('METRICS_PORT') or 0)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Seconds; wide enough for both frame-level gaps and slow extractions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Metric:
+    """A named family of series keyed by label values; safe from any thread
+
+    Values are either recorded directly or, for state that already lives
+    elsewhere, read at scrape time from a `collect` callback returning
+    {label values tuple: value}.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], Dict[tuple, float]]] = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._series = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """(suffix, label string, value) tuples in exposition order"""
+        if self.collect is not None:
+            try:
+                series = {tuple(str(v) for v in key): value for key, value in self.collect().items()}
+            except Exception as e:
+                print(f"Error collecting {self.name}: {e}")
+                return
+        else:
+            with self._lock:
+                series = dict(self._series)
+        for key, value in sorted(series.items()):
+            yield '', _format_labels(self.labels, key), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{suffix}{labels} {value:g}" for suffix, labels, value in self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), then sum and count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with-block takes, whether or not it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def summary(self, **labels) -> Tuple[int, float, float]:
+        """(count, mean, approximate 95th percentile) for one series"""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            if not series:
+                return 0, 0.0, 0.0
+            counts, total, count = list(series[0]), series[1], series[2]
+        target = count * 0.95
+        seen = 0
+        p95 = float('inf')
+        for bound, bucket in zip(self.buckets, counts):
+            seen += bucket
+            if seen >= target:
+                p95 = bound
+                break
+        return count, total / count, p95
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(value[0]), value[1], value[2]) for key, value in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                yield '_bucket', _format_labels(self.labels, key, f'le="{le}"'), cumulative
+            yield '_sum', _format_labels(self.labels, key), total
+            yield '_count', _format_labels(self.labels, key), count
+
+registry: Dict[str, Metric] = {}
+
+def render() -> str:
+    """Every registered metric in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in list(registry.values())) + '\n'
+
+# Blocking work on the bounded executors (yt-dlp, Spotify, Genius)
+executor_wait_seconds = Histogram('executor_wait_seconds', 'Time calls waited for a free worker', ('pool',))
+executor_call_seconds = Histogram('executor_call_seconds', 'Time calls spent running on a worker', ('pool',))
+executor_rejected_total = Counter('executor_rejected_total', 'Calls refused or abandoned by a pool', ('pool', 'reason'))
+
+# Playback
+time_to_first_audio_seconds = Histogram(
+    'time_to_first_audio_seconds', 'Time from a song being queued on an idle player to playback starting'
+)
+track_gap_seconds = Histogram('track_gap_seconds', 'Silence between one song ending and the next starting')
+songs_started_total = Counter('songs_started_total', 'Songs handed to a voice client')
+song_failures_total = Counter('song_failures_total', 'Songs that could not be started')
+prepared_handoffs_total = Counter(
+    'prepared_handoffs_total', 'Track changes that used (hit) or missed a pre-buffered player', ('result',)
+)
+
+# Playlist imports
+playlist_imports_total = Counter('playlist_imports_total', 'Spotify imports that completed or were cancelled', ('result',))
+
+# Autoplay
+autoplay_picks_total = Counter('autoplay_picks_total', 'Autoplay lookups that found a song or came up empty', ('result',))
+
+# Audio effects
+effect_swaps_total = Counter('effect_swaps_total', 'Filter graph changes applied to a playing stream')
+loudness_measure_seconds = Histogram(
+    'loudness_measure_seconds', 'Background loudness measurement passes', buckets=(1, 5, 10, 30, 60, 120, 300)
+)
+
+# Third-party clients, built on first use rather than at startup
+client_init_seconds = Histogram('client_init_seconds', 'Time to import and construct a client', ('client',))
+
+# Rate limiting and admission control
+rate_limited_total = Counter('rate_limited_total', 'Commands delayed (queued) or refused by rate limits', ('result',))
+admission_waits_total = Counter('admission_waits_total', 'Extraction jobs that had to wait for capacity')
+admission_rejected_total = Counter('admission_rejected_total', 'Extraction jobs refused after waiting too long')
+
+# Voice connections
+voice_disconnects_total = Counter('voice_disconnects_total', 'Voice channels left on a timer', ('reason',))
+voice_reconnects_total = Counter('voice_reconnects_total', 'Reconnects after voice dropped unexpectedly', ('result',))
+
+# Persistence
+queue_store_seconds = Histogram('queue_store_seconds', 'Saved queue store operations', ('op',))
+
+# Commands
+commands_total = Counter('commands_total', 'Commands completed', ('command',))
+command_errors_total = Counter('command_errors_total', 'Commands that raised an error')
+
+class MetricsServer:
+    """Minimal HTTP server answering GET /metrics with `render()`"""
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self) -> None:
+        if not self.port:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader, writer) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Drain the headers; the request line is all we route on
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self) -> None:
+        if self._server:
+            self._server.close()
+            self._server = None
@@ -1,210 +1,417 @@
 import asyncio
+import dataclasses
+import time
+from contextlib import asynccontextmanager
 import discord
-import spotipy
-import lyricsgenius
-import json
-import pickle
-from pathlib import Path
+import metrics
+from audio_cache import audio_cache
+from audio_effects import (
+    EQ_PRESETS, MAX_BASS_BOOST, MAX_CROSSFADE, SPEED_PRESETS, AudioEffects, loudness_cache
+)
+from executors import extraction_pool, pools
+from guild_player import GuildPlayer
+from metrics import MetricsServer
+from play_history import play_history
+from lyrics_service import LyricsService
 from queue_manager import QueueManager, QueuedSong
+from rate_limits import (
+    CACHED_COST, COMMAND_COST, PLAYLIST_TRACK_COST, RATE_LIMIT_MAX_WAIT, AdmissionController, RateLimiter
+)
+from resolver import SEARCH_HOST, PlaylistResolver
+from search_cache import SearchCache
+from spotify_service import SpotifyService, parse_spotify_url
+from track_matcher import MATCH_CANDIDATES, MATCH_MIN_SCORE, best_match
+from ytdl_source import get_ytdl
 from discord.ext import commands
-from spotipy.oauth2 import SpotifyClientCredentials
-import yt_dlp
-import os
-
-# YT-DLP options
-ytdl_format_options = {
-    'format': 'bestaudio/best',
-    'restrictfilenames': True,
-    'noplaylist': False,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0',
-    # Optimize for audio quality
-    'preferredcodec': 'opus',
-    'preferredquality': '192',
-    # Enable fast start
-    'buffersize': 32768,
-    'audio_buffer_size': 50000,
-    # Use yt-dlp specific options
-    'extract_flat': True,
-    'extractor_retries': 3,
-    'http_chunk_size': 10485760,
-}
-
-ffmpeg_options = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn -af "volume=0.5" -loglevel error -bufsize 32k -maxrate 160k'
-}
-
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
-
-# Initialize Spotify client
-spotify = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
-    client_id=os.getenv('SPOTIFY_CLIENT_ID'),
-    client_secret=os.getenv('SPOTIFY_CLIENT_SECRET')
-))
-
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
-        self.data = data
-        self.title = data.get('title')
-        self.url = data.get('url')
-        self.duration = data.get('duration')
-        # Try to extract artist from title (Artist - Title format)
-        self.artist = data.get('artist') or (
-            data.get('title').split(' - ')[0] if ' - ' in data.get('title', '') 
-            else 'Unknown Artist'
-        )
 
-    @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
-        
-        if 'entries' in data:
-            data = data['entries'][0]
+try:
+    from contextlib import aclosing
+except ImportError:  # Python < 3.10
+    @asynccontextmanager
+    async def aclosing(generator):
+        try:
+            yield generator
+        finally:
+            await generator.aclose()
+
+# Playlist tracks committed to the queue per batch while importing
+IMPORT_BATCH_SIZE = 10
+# Seconds between edits of an import's progress message
+IMPORT_PROGRESS_INTERVAL = 3
+# Songs listed per !queue page
+QUEUE_PAGE_SIZE = 10
+
+def format_duration(seconds):
+    """Format seconds as m:ss, or h:mm:ss for long durations"""
+    minutes, seconds = divmod(int(seconds or 0), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def parse_timestamp(text):
+    """Parse seconds, m:ss or h:mm:ss into seconds; raises ValueError otherwise"""
+    seconds = 0
+    for part in text.split(':'):
+        if not part.isdigit():
+            raise ValueError(f"Not a timestamp: {text}")
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+def shorten(text, limit=80):
+    """Trim long titles so queue pages stay within embed limits"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+class ImportProgress:
+    """A playlist import's single status message, edited in place at a throttled rate"""
+    def __init__(self, message, description, total):
+        self.message = message
+        self.description = description
+        self.total = total
+        self.done = 0  # Tracks looked up so far
+        self.added = 0
+        self.duplicates = 0  # Tracks skipped because they were already queued
+        self._edited_at = time.monotonic()
+
+    async def update(self):
+        """Show the latest counts unless the message was edited moments ago"""
+        if time.monotonic() - self._edited_at >= IMPORT_PROGRESS_INTERVAL:
+            await self._edit(
+                f"Processing {self.description}: {self.done}/{self.total} tracks resolved, {self.added} queued..."
+            )
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+    async def finish(self, cancelled=False):
+        text = f"Added {self.added} of {self.total} tracks from {self.description} to queue"
+        if self.duplicates:
+            text += f" ({self.duplicates} already queued)"
+        await self._edit(f"Import cancelled. {text}" if cancelled else text)
+
+    async def _edit(self, content):
+        self._edited_at = time.monotonic()
+        try:
+            await self.message.edit(content=content)
+        except Exception as e:
+            print(f"Error updating import progress: {e}")
 
 class MusicCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.current_player = None
-        self.song_queue = []
-        self.volume = 0.5  # Default volume (50%)
-        self.loop_mode = "off"  # off, track, queue
-        self.current_ctx = None  # Store context for looping
-        self.genius = lyricsgenius.Genius(os.getenv('GENIUS_ACCESS_TOKEN'))
+        self.players = {}  # guild ID -> GuildPlayer, created on demand
+        self.lyrics_service = LyricsService()
         self.queue_manager = QueueManager()
-        self._load_saved_queue()
-
-    def _load_saved_queue(self):
-        """Load saved queue state"""
-        current_song, queue = self.queue_manager.load_queue()
-        if current_song:
-            self.bot.loop.create_task(self._restore_current_song(current_song))
-        for song in queue:
-            self.bot.loop.create_task(self._restore_queued_song(song))
-
-    async def _restore_current_song(self, song):
-        """Restore the current song from saved state"""
-        try:
-            player = await YTDLSource.from_url(song.url, loop=self.bot.loop, stream=True)
-            self.current_player = player
-        except Exception as e:
-            print(f"Error restoring current song: {e}")
+        self.resolver = PlaylistResolver()
+        self.search_cache = SearchCache()
+        self.spotify_service = SpotifyService()
+        self.rate_limiter = RateLimiter()
+        self.admission = AdmissionController()
+        self.metrics_server = MetricsServer()
+        self._register_metrics()
+
+    def _register_metrics(self):
+        """Expose per-guild and cache state that is read at scrape time"""
+        metrics.Gauge(
+            'guild_queue_length', 'Songs waiting in each guild queue', ('guild',),
+            collect=lambda: {(guild_id,): len(p.song_queue) for guild_id, p in self.players.items()}
+        )
+        metrics.Gauge(
+            'guild_queue_seconds', 'Total duration of each guild queue', ('guild',),
+            collect=lambda: {(guild_id,): p.song_queue.total_duration for guild_id, p in self.players.items()}
+        )
+        metrics.Gauge(
+            'guild_playing', 'Whether each guild has a song playing', ('guild',),
+            collect=lambda: {(guild_id,): int(p.current_player is not None) for guild_id, p in self.players.items()}
+        )
+        metrics.Counter(
+            'cache_hits_total', 'Lookups answered from a cache', ('cache',),
+            collect=lambda: {('search',): self.search_cache.hits, ('lyrics',): self.lyrics_service.hits}
+        )
+        metrics.Counter(
+            'cache_misses_total', 'Lookups that missed a cache', ('cache',),
+            collect=lambda: {('search',): self.search_cache.misses, ('lyrics',): self.lyrics_service.misses}
+        )
+        metrics.Counter(
+            'spotify_api_calls_total', 'Requests sent to the Spotify Web API',
+            collect=lambda: {(): self.spotify_service.api_calls}
+        )
+        metrics.Gauge(
+            'audio_cache_bytes', 'Size of the local Opus cache',
+            collect=lambda: {(): audio_cache.stats()['bytes']}
+        )
 
-    async def _restore_queued_song(self, song):
-        """Restore a queued song from saved state"""
-        try:
-            player = await YTDLSource.from_url(song.url, loop=self.bot.loop, stream=True)
-            self.song_queue.append((player, None))
-        except Exception as e:
-            print(f"Error restoring queued song: {e}")
-
-    def _save_queue_state(self):
-        """Save current queue state"""
-        current_song = None
-        if self.current_player:
-            current_song = QueuedSong(
-                title=self.current_player.title,
-                url=self.current_player.url,
-                duration=self.current_player.duration,
-                artist=self.current_player.artist
-            )
-        
-        queue = [
-            QueuedSong(
-                title=player.title,
-                url=player.url,
-                duration=player.duration,
-                artist=player.artist
-            )
-            for player, _ in self.song_queue
-        ]
-        
-        self.queue_manager.save_queue(current_song, queue)
+    async def cog_load(self):
+        """Rebuild every saved queue from stored metadata without extracting anything"""
+        await self.metrics_server.start()
+        saved = await self.bot.loop.run_in_executor(None, self.queue_manager.load_all)
+        # Other workers restore the guilds on their own shards
+        saved = {guild_id: state for guild_id, state in saved.items() if self._owns_guild(guild_id)}
+        for guild_id, saved_state in saved.items():
+            self.players[guild_id] = self._create_player(guild_id, saved_state)
+        if saved:
+            print(f"Restored saved queues for {len(saved)} guild(s)")
+
+    def _owns_guild(self, guild_id):
+        """Whether a guild's shard runs in this process"""
+        shard_count = getattr(self.bot, 'shard_count', None)
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_count or shard_ids is None:
+            return True
+        return (guild_id >> 22) % shard_count in shard_ids
+
+    def get_player(self, ctx):
+        """Return the guild's player, creating one for commands that start playback
+
+        Saved queues were all restored in cog_load, so a new player starts
+        empty. Commands that only read or adjust a session use
+        `self.players.get` instead, so they never leave a player behind in
+        a guild with no voice connection.
+        """
+        player = self.players.get(ctx.guild.id)
+        if player is None:
+            player = self._create_player(ctx.guild.id, None)
+            self.players[ctx.guild.id] = player
+        return player
+
+    def _create_player(self, guild_id, saved_state):
+        return GuildPlayer(
+            self.bot, guild_id, self.queue_manager, self.admission,
+            on_destroy=self._remove_player,
+            on_song_start=self._on_song_start,
+            saved_state=saved_state
+        )
 
-    async def process_playlist(self, ctx, playlist_data):
-        """Process and queue all songs from a playlist"""
-        entries = playlist_data.get('entries', [])
-        if not entries:
-            await ctx.send("No playable items found in playlist")
+    def _on_song_start(self, player, song):
+        """Warm the lyrics cache for the song that just started and the one after it"""
+        self.lyrics_service.prefetch(song.title)
+        upcoming = player.upcoming_song()
+        if upcoming and upcoming is not song:
+            self.lyrics_service.prefetch(upcoming.title)
+
+    def _remove_player(self, player):
+        """Forget a guild's player once it has been torn down"""
+        if self.players.get(player.guild_id) is player:
+            del self.players[player.guild_id]
+
+    def cog_unload(self):
+        """Write out pending queue state and stop the thread pools before the cog goes away"""
+        # Saved with each current song's exact position, to resume there after a restart
+        for player in list(self.players.values()):
+            player.cancel_import()
+            player.save_state()
+        self.queue_manager.close()
+        self.search_cache.close()
+        self.lyrics_service.close()
+        self.spotify_service.close()
+        loudness_cache.close()
+        play_history.close()
+        self.metrics_server.close()
+        for pool in pools.values():
+            pool.shutdown()
+
+    async def cog_check(self, ctx):
+        """Music commands need a guild to hold their player"""
+        return ctx.guild is not None
+
+    async def cog_after_invoke(self, ctx):
+        metrics.commands_total.inc(command=ctx.command.qualified_name)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Track the bot's own connection and whether anyone is left listening"""
+        player = self.players.get(member.guild.id)
+        if player is None or before.channel == after.channel:
             return
-
-        # Add first song to play immediately if nothing is playing
-        first_entry = entries[0]
-        first_player = await YTDLSource.from_url(first_entry['url'], loop=self.bot.loop, stream=True)
-        
-        if ctx.voice_client.is_playing():
-            self.song_queue.append((first_player, ctx))
-            await ctx.send(f'Added to queue: {first_player.title}')
+        if member.id == self.bot.user.id:
+            if after.channel is None:
+                player.voice.disconnected(before.channel)
+            else:
+                player.voice.joined(member.guild)
         else:
-            first_player.volume = self.volume
-            ctx.voice_client.play(first_player, after=lambda e: self.play_next(ctx))
-            self.current_player = first_player
-            self.current_ctx = ctx
-            await ctx.send(f'Now playing: {first_player.title}')
-
-        # Queue remaining songs
-        for entry in entries[1:]:
-            try:
-                player = await YTDLSource.from_url(entry['url'], loop=self.bot.loop, stream=True)
-                self.song_queue.append((player, ctx))
-            except Exception as e:
-                print(f"Error processing playlist item: {e}")
-                continue
+            player.voice.listeners_changed(member.guild)
 
-        await ctx.send(f'Added {len(entries)} songs from playlist to queue')
-        self._save_queue_state()
-
-    async def get_spotify_playlist_tracks(self, playlist_url):
-        """Get all tracks from a Spotify playlist"""
+    async def _run_import(self, ctx, importer, *args):
+        """Run an import as the guild's cancellable import task and wait for it"""
+        player = self.get_player(ctx)
+        if player.importing:
+            await ctx.send("❌ A playlist import is already running. Use !cancel to stop it first.")
+            return
+        task = player.importing = self.bot.loop.create_task(importer(ctx, *args))
         try:
-            if 'playlist' in playlist_url:
-                playlist_id = playlist_url.split('/')[-1].split('?')[0]
-                results = spotify.playlist_tracks(playlist_id)
-                tracks = results['items']
-                
-                # Handle pagination
-                while results['next']:
-                    results = spotify.next(results)
-                    tracks.extend(results['items'])
-
-                search_queries = []
-                for item in tracks:
-                    track = item['track']
-                    if track:  # Some tracks might be None due to availability
-                        artist = track['artists'][0]['name']
-                        name = track['name']
-                        search_queries.append(f"{artist} - {name}")
-                return search_queries
-            return []
-        except Exception as e:
-            raise Exception(f"Error processing Spotify playlist: {str(e)}")
-
-    async def get_spotify_track_url(self, spotify_url):
-        """Convert Spotify URL to YouTube search query"""
+            await task
+        except asyncio.CancelledError:
+            # Cancelled by !cancel or !stop before it could report; the command just ends
+            if not task.cancelled():
+                raise
+        finally:
+            if player.importing is task:
+                player.importing = None
+
+    async def _run_lookup(self, player, lookup):
+        """Run a single-track lookup as one of the player's cancellable lookups
+
+        Returns its song, or None if !stop cancelled it first.
+        """
+        task = self.bot.loop.create_task(lookup)
+        player.lookups.add(task)
         try:
-            # Extract track ID from URL
-            track_id = spotify_url.split('/')[-1].split('?')[0]
-            track = spotify.track(track_id)
-            search_query = f"{track['artists'][0]['name']} - {track['name']}"
-            data = await self.bot.loop.run_in_executor(
-                None, 
-                lambda: ytdl.extract_info(f"ytsearch:{search_query}", download=False)
+            return await task
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            return None
+        finally:
+            player.lookups.discard(task)
+
+    async def _lookup_track(self, ctx, player, query, spotify_track=None):
+        """Find and resolve the one song a !play asked for; None (reported) when a search finds nothing"""
+        if spotify_track:
+            query = await self.get_spotify_track_url(spotify_track, ctx.guild.id)
+        elif not ('youtube.com' in query or 'youtu.be' in query):
+            # Treat as search query
+            song = await self._search_song(query, guild_id=ctx.guild.id)
+            if not song:
+                await ctx.send("No results found.")
+                return None
+            query = song.url
+
+        # Resolve the single track now so the queue shows its real title
+        song = QueuedSong.from_entry({'url': query})
+        await player.resolve(song)
+        return song
+
+    def _commit(self, ctx, songs, seen, progress):
+        """Queue one batch of imported songs, counting the ones already queued"""
+        added = self.get_player(ctx).enqueue_new(ctx, songs, seen)
+        progress.added += added
+        progress.duplicates += len(songs) - added
+
+    async def _import_playlist(self, ctx, query):
+        """Extract a YouTube playlist and queue its entries"""
+        status = await ctx.send("Processing playlist...")
+        try:
+            async with self.admission.slot(ctx.guild.id):
+                data = await extraction_pool.run(lambda: get_ytdl().extract_info(query, download=False))
+        except asyncio.CancelledError:
+            await status.edit(content="Import cancelled.")
+            return
+        self.rate_limiter.charge(ctx.author.id, ctx.guild.id, PLAYLIST_TRACK_COST * len(data.get('entries') or []))
+        await self.process_playlist(ctx, data, status)
+
+    async def process_playlist(self, ctx, playlist_data, status):
+        """Queue all songs from a playlist that are not already queued"""
+        entries = [entry for entry in playlist_data.get('entries', []) if entry]
+        if not entries:
+            await status.edit(content="No playable items found in playlist")
+            return
+
+        # Flat entries already carry title and duration; streams resolve lazily
+        progress = ImportProgress(status, 'playlist', len(entries))
+        progress.done = len(entries)
+        self._commit(ctx, [QueuedSong.from_entry(entry) for entry in entries], self.get_player(ctx).queued_ids(), progress)
+        await progress.finish()
+
+    async def _admit(self, ctx, cost):
+        """Charge a command against the user's and guild's budgets, waiting briefly if over"""
+        delay = self.rate_limiter.delay(ctx.author.id, ctx.guild.id)
+        if delay > RATE_LIMIT_MAX_WAIT:
+            metrics.rate_limited_total.inc(result='refused')
+            await ctx.send(f"⏳ Slow down! Try again in {delay:.0f}s.")
+            return False
+        if delay > 0:
+            metrics.rate_limited_total.inc(result='queued')
+            await asyncio.sleep(delay)
+        self.rate_limiter.charge(ctx.author.id, ctx.guild.id, cost)
+        return True
+
+    async def _search_song(self, search_query, cache_key=None, guild_id=None):
+        """Look up a search query's top YouTube result without resolving its stream"""
+        cache_key = cache_key or SearchCache.query_key(search_query)
+        song = self.search_cache.get(cache_key)
+        if song:
+            return song
+
+        async with self.admission.slot(guild_id):
+            data = await extraction_pool.run(
+                lambda: get_ytdl().extract_info(f"ytsearch:{search_query}", download=False)
             )
-            if not data.get('entries'):
-                raise Exception("No YouTube results found for this track")
-            return data['entries'][0]['url']
-        except Exception as e:
-            raise Exception(f"Error processing Spotify link: {str(e)}")
+        if not data.get('entries'):
+            return None
+        song = QueuedSong.from_entry(data['entries'][0])
+        self.search_cache.put(cache_key, song)
+        return song
+
+    async def _match_spotify_track(self, track, guild_id=None, bulk=False):
+        """Pick the YouTube result that best matches a Spotify track, caching the choice"""
+        cache_key = SearchCache.spotify_key(track.id)
+        song = self.search_cache.get(cache_key)
+        if song:
+            return song
+
+        async def candidates(query):
+            async with self.admission.slot(guild_id, bulk=bulk):
+                data = await extraction_pool.run(
+                    lambda: get_ytdl().extract_info(f"ytsearch{MATCH_CANDIDATES}:{query}", download=False)
+                )
+            return data.get('entries') or []
+
+        entry, score = best_match(track, await candidates(track.search_query))
+        if track.isrc and score < MATCH_MIN_SCORE:
+            # Topic channel uploads list the ISRC, so it often finds the studio recording
+            isrc_entry, isrc_score = best_match(track, await candidates(f'"{track.isrc}"'))
+            if isrc_score > score:
+                entry = isrc_entry
+        if entry is None:
+            return None
+        song = QueuedSong.from_entry(entry)
+        self.search_cache.put(cache_key, song)
+        return song
+
+    async def _import_searches(self, ctx, tracks, kind='playlist'):
+        """Search Spotify tracks on YouTube in parallel and queue them in order, in batches"""
+        # Big imports may overdraw the budget; later commands wait it off
+        self.rate_limiter.charge(ctx.author.id, ctx.guild.id, PLAYLIST_TRACK_COST * len(tracks))
+        status = await ctx.send(f"Processing Spotify {kind} with {len(tracks)} tracks...")
+        progress = ImportProgress(status, f"Spotify {kind}", len(tracks))
+        seen = self.get_player(ctx).queued_ids()
+        pending = []
+
+        def on_progress(done, total):
+            progress.done = done
+
+        results = self.resolver.resolve(
+            tracks,
+            # The first track starts playback, so only the rest count as bulk work
+            lambda track: self._match_spotify_track(track, ctx.guild.id, bulk=track is not tracks[0]),
+            host=SEARCH_HOST,
+            on_progress=on_progress
+        )
+        try:
+            # Closed on the way out, so the resolver's workers stop now rather than whenever it is collected
+            async with aclosing(results):
+                async for index, song in results:
+                    if song:
+                        pending.append(song)
+                    # The first hit is queued alone so playback starts right away
+                    if pending and (progress.added + progress.duplicates == 0 or len(pending) >= IMPORT_BATCH_SIZE):
+                        self._commit(ctx, pending, seen, progress)
+                        pending = []
+                    await progress.update()
+        except asyncio.CancelledError:
+            # Closing the results cancelled the resolver's workers and their queued lookups
+            metrics.playlist_imports_total.inc(result='cancelled')
+            await progress.finish(cancelled=True)
+            return
+
+        if pending:
+            self._commit(ctx, pending, seen, progress)
+        metrics.playlist_imports_total.inc(result='completed')
+        await progress.finish()
+
+    async def get_spotify_track_url(self, track, guild_id=None):
+        """Find the YouTube video for a single Spotify track"""
+        song = await self._match_spotify_track(track, guild_id)
+        if not song:
+            raise Exception("No YouTube results found for this track")
+        return song.url
 
     @commands.command(name='play')
     async def play(self, ctx, *, query):
@@ -220,85 +427,58 @@ class MusicCog(commands.Cog):
                 await ctx.send("❌ I don't have permission to join or speak in that voice channel!")
                 return
 
+            # Searches already in the cache are cheap; everything else costs a lookup.
+            # Checked before joining so a refused command never leaves the bot in voice.
+            cached = self.search_cache.contains(SearchCache.query_key(query))
+            if not await self._admit(ctx, CACHED_COST if cached else COMMAND_COST):
+                return
+
+            # Created before joining, so the join's voice state update reaches the player
+            # and the idle timer covers a !play that ends up queuing nothing
+            player = self.get_player(ctx)
+
             # Auto-connect to the user's voice channel
             if ctx.voice_client is None:
-                await ctx.message.author.voice.channel.connect()
+                try:
+                    await ctx.message.author.voice.channel.connect()
+                except Exception:
+                    if player.is_idle():
+                        player.destroy()
+                    raise
             elif ctx.voice_client.channel != ctx.message.author.voice.channel:
                 await ctx.voice_client.move_to(ctx.message.author.voice.channel)
 
             try:
                 async with ctx.typing():
                     # Handle different input types
-                    if 'spotify.com' in query:
-                        if 'playlist' in query:
-                            # Handle Spotify playlist
-                            search_queries = await self.get_spotify_playlist_tracks(query)
-                            await ctx.send(f"Processing Spotify playlist with {len(search_queries)} tracks...")
-                            
-                            for i, search_query in enumerate(search_queries):
-                                try:
-                                    data = await self.bot.loop.run_in_executor(
-                                        None,
-                                        lambda: ytdl.extract_info(f"ytsearch:{search_query}", download=False)
-                                    )
-                                    if data.get('entries'):
-                                        player = await YTDLSource.from_url(
-                                            data['entries'][0]['url'],
-                                            loop=self.bot.loop,
-                                            stream=True
-                                        )
-                                        if i == 0 and not ctx.voice_client.is_playing():
-                                            player.volume = self.volume
-                                            ctx.voice_client.play(player, after=lambda e: self.play_next(ctx))
-                                            self.current_player = player
-                                            self.current_ctx = ctx
-                                            await ctx.send(f'Now playing: {player.title}')
-                                        else:
-                                            self.song_queue.append((player, ctx))
-                                except Exception as e:
-                                    print(f"Error processing track {i+1}: {e}")
-                                    continue
-                            
-                            self._save_queue_state()
+                    spotify_link = parse_spotify_url(query)
+                    if spotify_link:
+                        kind = spotify_link[0]
+                        try:
+                            tracks = await self.spotify_service.resolve_url(query)
+                        except Exception as e:
+                            raise Exception(f"Error processing Spotify link: {str(e)}")
+                        if not tracks:
+                            await ctx.send("No playable tracks found on Spotify.")
+                            return
+                        if kind != 'track':
+                            # Handle Spotify playlists, albums and artist top tracks
+                            kind = 'top tracks' if kind == 'artist' else kind
+                            await self._run_import(ctx, self._import_searches, tracks, kind)
                             return
-                        else:
-                            # Handle single Spotify track
-                            query = await self.get_spotify_track_url(query)
+                        # Handle single Spotify track
+                        song = await self._run_lookup(player, self._lookup_track(ctx, player, query, tracks[0]))
                     elif 'youtube.com/playlist' in query or 'youtu.be/playlist' in query:
                         # Handle YouTube playlist
-                        data = await self.bot.loop.run_in_executor(
-                            None,
-                            lambda: ytdl.extract_info(query, download=False)
-                        )
-                        await self.process_playlist(ctx, data)
+                        await self._run_import(ctx, self._import_playlist, query)
                         return
-                    elif not ('youtube.com' in query or 'youtu.be' in query):
-                        # Treat as search query
-                        search_query = f"ytsearch:{query}"
-                        data = await self.bot.loop.run_in_executor(
-                            None, 
-                            lambda: ytdl.extract_info(search_query, download=False)
-                        )
-                        if not data.get('entries'):
-                            await ctx.send("No results found.")
-                            return
-                        query = data['entries'][0]['url']
-                    
-                    # Get the player for single track
-                    player = await YTDLSource.from_url(query, loop=self.bot.loop, stream=True)
-                    
-                    # If something is playing, add to queue
-                    if ctx.voice_client.is_playing():
-                        self.song_queue.append((player, ctx))
-                        self._save_queue_state()
-                        await ctx.send(f'Added to queue: {player.title}')
                     else:
-                        # Play the track immediately
-                        player.volume = self.volume
-                        ctx.voice_client.play(player, after=lambda e: self.play_next(ctx))
-                        self.current_player = player
-                        self.current_ctx = ctx
-                        await ctx.send(f'Now playing: {player.title}')
+                        song = await self._run_lookup(player, self._lookup_track(ctx, player, query))
+                    if song is None:
+                        return  # Nothing found, or !stop came first
+
+                    if player.enqueue(ctx, [song]) is None:
+                        await ctx.send(f'Added to queue: {song.title}')
             except Exception as e:
                 error_msg = "❌ An error occurred: "
                 if "Video unavailable" in str(e):
@@ -319,15 +499,24 @@ class MusicCog(commands.Cog):
     async def stop(self, ctx):
         """Stops playback and disconnects the bot"""
         if ctx.voice_client:
-            self.song_queue.clear()  # Clear the queue
-            self.current_player = None
-            self.current_ctx = None
-            ctx.voice_client.stop()
-            await ctx.voice_client.disconnect()
+            player = self.players.get(ctx.guild.id)
+            if player:
+                player.clear()  # Clear the queue
+                player.save_state()
+                await player.voice.leave(ctx.guild)  # Idle now, so this also tears the player down
+            else:
+                await ctx.voice_client.disconnect()
             await ctx.send("Stopped playing, cleared queue, and disconnected")
         else:
             await ctx.send("I'm not connected to a voice channel")
 
+    @commands.command(name='cancel')
+    async def cancel(self, ctx):
+        """Stops a running playlist import, keeping the songs it already queued"""
+        player = self.players.get(ctx.guild.id)
+        if not player or not player.cancel_import():
+            await ctx.send("❌ No playlist import is running.")
+
     @commands.command(name='pause')
     async def pause(self, ctx):
         """Pauses the currently playing audio"""
@@ -339,140 +528,133 @@ class MusicCog(commands.Cog):
 
     @commands.command(name='resume')
     async def resume(self, ctx):
-        """Resumes the currently paused audio"""
+        """Resumes the currently paused audio, or starts a restored queue"""
+        player = self.players.get(ctx.guild.id)
         if ctx.voice_client and ctx.voice_client.is_paused():
             ctx.voice_client.resume()
             await ctx.send("Playback resumed")
+        elif player and player.has_restored_queue() and ctx.author.voice:
+            # Songs were restored after a restart; join and start from the head
+            if ctx.voice_client is None:
+                await ctx.author.voice.channel.connect()
+            if not ctx.voice_client.is_playing():
+                player.play_next(ctx)
+                await ctx.send("Resuming the saved queue")
         else:
             await ctx.send("Nothing is paused right now")
 
-    def play_next(self, ctx):
-        """Play the next song in the queue"""
-        if not ctx.voice_client:
-            return
-            
-        if self.loop_mode == "track" and self.current_player:
-            # Replay the current track
-            player = self.current_player
-            ctx = self.current_ctx
-            player.volume = self.volume
-            ctx.voice_client.play(player, after=lambda e: self.play_next(ctx))
-            asyncio.run_coroutine_threadsafe(
-                ctx.send(f'Looping track: {player.title}'),
-                self.bot.loop
-            )
-        elif self.song_queue:
-            next_player, next_ctx = self.song_queue.pop(0)
-            next_player.volume = self.volume
-            next_ctx.voice_client.play(next_player, after=lambda e: self.play_next(next_ctx))
-            self.current_player = next_player
-            self.current_ctx = next_ctx
-            self._save_queue_state()
-            asyncio.run_coroutine_threadsafe(
-                next_ctx.send(f'Now playing: {next_player.title}'),
-                self.bot.loop
-            )
-            
-            # If queue loop is enabled, add the song back to the end
-            if self.loop_mode == "queue":
-                self.song_queue.append((self.current_player, self.current_ctx))
-        else:
-            # No more songs in queue, disconnect after a delay
-            self.current_player = None
-            self.current_ctx = None
-            asyncio.run_coroutine_threadsafe(
-                self._disconnect_after_delay(ctx), 
-                self.bot.loop
-            )
-
     @commands.command(name='skip')
     async def skip(self, ctx):
         """Skip the current song"""
-        if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-            ctx.voice_client.stop()  # This will trigger play_next via the after callback
+        player = self.players.get(ctx.guild.id)
+        if player and player.skip(ctx):
             await ctx.send("Skipped the current song")
         else:
             await ctx.send("Nothing is playing right now")
 
-    async def _disconnect_after_delay(self, ctx):
-        """Disconnect from voice after a delay if nothing is playing"""
-        await asyncio.sleep(180)  # 3 minutes delay
-        if ctx.voice_client and not ctx.voice_client.is_playing():
-            await ctx.voice_client.disconnect()
-            await ctx.send("Disconnected due to inactivity")
-
     @commands.command(name='nowplaying', aliases=['np'])
     async def nowplaying(self, ctx):
         """Display information about the current track"""
-        if not self.current_player:
+        player = self.players.get(ctx.guild.id)
+        if not player or not player.current_player:
             await ctx.send("No song is currently playing!")
             return
 
-        # Format duration
-        duration = self.current_player.duration
-        minutes = duration // 60
-        seconds = duration % 60
-        duration_str = f"{minutes}:{seconds:02d}"
+        # Format position and duration
+        duration_str = format_duration(player.current_player.duration)
+        if player.current_player.duration:
+            duration_str = f"{format_duration(player.current_player.position)} / {duration_str}"
 
         embed = discord.Embed(title="Now Playing", color=discord.Color.blue())
-        embed.add_field(name="Title", value=self.current_player.title, inline=False)
-        embed.add_field(name="Artist", value=self.current_player.artist, inline=True)
+        embed.add_field(name="Title", value=player.current_player.title, inline=False)
+        embed.add_field(name="Artist", value=player.current_player.artist, inline=True)
         embed.add_field(name="Duration", value=duration_str, inline=True)
-        embed.add_field(name="URL", value=self.current_player.url, inline=False)
+        embed.add_field(name="URL", value=player.current_player.webpage_url, inline=False)
 
         await ctx.send(embed=embed)
 
     @commands.command(name='queue')
-    async def queue(self, ctx):
-        """Display the current song queue"""
-        if not self.current_player and not self.song_queue:
+    async def queue(self, ctx, page: int = 1):
+        """Display the current song queue, one page at a time"""
+        player = self.players.get(ctx.guild.id)
+        if not player or (not player.current_player and not player.song_queue):
             await ctx.send("The queue is empty")
             return
 
-        queue_msg = []
-        if self.current_player:
-            queue_msg.append(f"Currently playing: {self.current_player.title}")
-        
-        if self.song_queue:
-            queue_msg.append("\nUp next:")
-            for i, (player, _) in enumerate(self.song_queue, 1):
-                queue_msg.append(f"{i}. {player.title}")
+        song_queue = player.song_queue
+        pages = max(1, -(-len(song_queue) // QUEUE_PAGE_SIZE))
+        page = min(max(page, 1), pages)
+        start = (page - 1) * QUEUE_PAGE_SIZE
+
+        embed = discord.Embed(title="Queue", color=discord.Color.blue())
+        if player.current_player:
+            embed.add_field(name="Currently playing", value=shorten(player.current_player.title), inline=False)
+
+        if song_queue:
+            lines = [
+                f"{i}. {shorten(song.title)} ({format_duration(song.duration)})"
+                for i, (song, _) in enumerate(song_queue.page(start, QUEUE_PAGE_SIZE), start + 1)
+            ]
+            embed.add_field(name="Up next", value="\n".join(lines), inline=False)
         else:
-            queue_msg.append("\nNo songs in queue")
+            embed.add_field(name="Up next", value="No songs in queue", inline=False)
 
-        await ctx.send("\n".join(queue_msg))
+        embed.set_footer(
+            text=f"Page {page}/{pages} · {len(song_queue)} songs · {format_duration(song_queue.total_duration)} total"
+        )
+        await ctx.send(embed=embed)
+
+    @commands.command(name='remove')
+    async def remove(self, ctx, position: int):
+        """Remove a song from the queue by its position"""
+        player = self.players.get(ctx.guild.id)
+        if not player or not 1 <= position <= len(player.song_queue):
+            return await ctx.send("❌ Invalid queue position")
+        song, _ = player.song_queue.remove(position - 1)
+        player.queue_changed()
+        await ctx.send(f"Removed from queue: {song.title}")
+
+    @commands.command(name='move')
+    async def move(self, ctx, source: int, destination: int):
+        """Move a song to a different position in the queue"""
+        player = self.players.get(ctx.guild.id)
+        size = len(player.song_queue) if player else 0
+        if not (1 <= source <= size and 1 <= destination <= size):
+            return await ctx.send("❌ Invalid queue position")
+        player.song_queue.move(source - 1, destination - 1)
+        player.queue_changed()
+        await ctx.send(f"Moved {player.song_queue[destination - 1][0].title} to position {destination}")
+
+    @commands.command(name='shuffle')
+    async def shuffle(self, ctx):
+        """Shuffle the songs waiting in the queue"""
+        player = self.players.get(ctx.guild.id)
+        if not player or not player.song_queue:
+            return await ctx.send("The queue is empty")
+        player.song_queue.shuffle()
+        player.queue_changed()
+        await ctx.send(f"Shuffled {len(player.song_queue)} songs")
 
     @commands.command(name='lyrics')
     async def lyrics(self, ctx):
         """Display lyrics for the currently playing song"""
-        if not self.current_player:
+        player = self.players.get(ctx.guild.id)
+        if not player or not player.current_player:
             await ctx.send("No song is currently playing!")
             return
+        cached = self.lyrics_service.is_cached(player.current_player.title)
+        if not await self._admit(ctx, CACHED_COST if cached else COMMAND_COST):
+            return
 
         async with ctx.typing():
             try:
-                # Extract artist and title from the video title
-                title = self.current_player.title
-                # Remove common YouTube suffixes
-                title = title.replace("(Official Video)", "").replace("(Official Audio)", "")
-                title = title.replace("[Official Video]", "").replace("[Official Audio]", "")
-                title = title.strip()
-
-                # Try to split artist and song name if they're separated by a dash
-                if " - " in title:
-                    artist, song = title.split(" - ", 1)
-                else:
-                    # If no dash, search with full title
-                    artist = ""
-                    song = title
-
-                # Search for the song
-                song = self.genius.search_song(song, artist)
+                # Usually answered from the cache, warmed when the song started
+                song = await self.lyrics_service.get(player.current_player.title)
                 
                 if song:
-                    # Split lyrics into chunks if they're too long
+                    # Split lyrics into chunks that fit a message with the code fence
                     lyrics = song.lyrics
-                    chunks = [lyrics[i:i+2000] for i in range(0, len(lyrics), 2000)]
+                    chunks = [lyrics[i:i+1990] for i in range(0, len(lyrics), 1990)]
                     
                     # Send the first message with song info
                     await ctx.send(f"📜 Lyrics for: {song.title} by {song.artist}")
@@ -485,6 +667,28 @@ class MusicCog(commands.Cog):
             except Exception as e:
                 await ctx.send(f"An error occurred while fetching lyrics: {str(e)}")
         
+    @commands.command(name='seek')
+    async def seek(self, ctx, position: str):
+        """Jump to a time in the current song (e.g. 1:30, 90, +15, -10)"""
+        player = self.players.get(ctx.guild.id)
+        if not player or not player.current_player:
+            return await ctx.send("No song is currently playing!")
+        try:
+            seconds = parse_timestamp(position.lstrip('+-'))
+        except ValueError:
+            return await ctx.send("❌ Use a time like 1:30, 90, +15 or -10.")
+        if position[0] in '+-':
+            seconds = player.current_player.position + (seconds if position[0] == '+' else -seconds)
+        duration = player.current_player.duration
+        if duration and seconds >= duration:
+            return await ctx.send(f"❌ This song is only {format_duration(duration)} long.")
+        seconds = max(0, seconds)
+        try:
+            await player.seek(seconds)
+        except Exception as e:
+            return await ctx.send(f"❌ Couldn't seek: {str(e)}")
+        await ctx.send(f"Jumped to {format_duration(seconds)}")
+
     @commands.command(name='volume')
     async def volume(self, ctx, volume: int):
         """Change the player volume (0-100)"""
@@ -499,10 +703,12 @@ class MusicCog(commands.Cog):
             if not ctx.author.voice or ctx.author.voice.channel != ctx.voice_client.channel:
                 return await ctx.send("❌ You must be in the same voice channel to change the volume.")
                 
-            self.volume = volume / 100  # Convert to float between 0 and 1
+            player = self.players.get(ctx.guild.id)
+            if player:
+                player.volume = volume / 100  # Convert to float between 0 and 1
             
             if ctx.voice_client.source:
-                ctx.voice_client.source.volume = self.volume
+                ctx.voice_client.source.volume = volume / 100
                 
             await ctx.send(f"Volume set to {volume}%")
         except Exception as e:
@@ -512,14 +718,120 @@ class MusicCog(commands.Cog):
     async def loop(self, ctx, mode: str = None):
         """Set loop mode (off/track/queue)"""
         valid_modes = ['off', 'track', 'queue']
+        player = self.players.get(ctx.guild.id)
+        if player is None:
+            return await ctx.send("❌ Nothing is playing. Use !play first.")
         
         # If no mode specified, cycle through modes
         if mode is None:
-            current_index = valid_modes.index(self.loop_mode)
-            self.loop_mode = valid_modes[(current_index + 1) % len(valid_modes)]
+            current_index = valid_modes.index(player.loop_mode)
+            player.loop_mode = valid_modes[(current_index + 1) % len(valid_modes)]
         elif mode.lower() in valid_modes:
-            self.loop_mode = mode.lower()
+            player.loop_mode = mode.lower()
         else:
             return await ctx.send("Invalid loop mode. Use: off, track, or queue")
             
-        await ctx.send(f"Loop mode set to: {self.loop_mode}")
+        await ctx.send(f"Loop mode set to: {player.loop_mode}")
+
+    @commands.command(name='autoplay')
+    async def autoplay(self, ctx, mode: str = None):
+        """Keep playing related songs from the play history when the queue runs out (on/off)"""
+        player = self.players.get(ctx.guild.id)
+        if player is None:
+            return await ctx.send("❌ Nothing is playing. Use !play first.")
+        if mode is None:
+            enabled = not player.autoplay
+        elif mode.lower() in ('on', 'off'):
+            enabled = mode.lower() == 'on'
+        else:
+            return await ctx.send("Invalid autoplay mode. Use: on or off")
+
+        player.set_autoplay(enabled)
+        await ctx.send(f"Autoplay {'on' if enabled else 'off'}")
+
+    @commands.command(name='fx')
+    async def fx(self, ctx, setting: str = None, value: str = None):
+        """Show or change audio effects (normalize, eq, bass, speed, crossfade, reset)"""
+        player = self.players.get(ctx.guild.id)
+        if player is None:
+            return await ctx.send("❌ Nothing is playing. Use !play first.")
+        effects = player.effects
+        usage = (
+            "Usage: `!fx normalize on|off`, `!fx eq " + '|'.join(EQ_PRESETS) + "`, "
+            f"`!fx bass <0-{MAX_BASS_BOOST}>`, `!fx speed " + '|'.join(SPEED_PRESETS) + "|<0.5-2.0>`, "
+            f"`!fx crossfade <0-{MAX_CROSSFADE}>`, `!fx reset`"
+        )
+        if setting is None:
+            return await ctx.send(f"Audio effects: {effects.describe()}\n{usage}")
+
+        setting = setting.lower()
+        value = (value or '').lower()
+        try:
+            if setting == 'reset':
+                effects = AudioEffects()
+            elif setting == 'normalize' and value in ('on', 'off'):
+                effects = dataclasses.replace(effects, normalize=value == 'on')
+            elif setting == 'eq' and value in EQ_PRESETS:
+                effects = dataclasses.replace(effects, eq=value)
+            elif setting == 'bass' and value.isdigit() and int(value) <= MAX_BASS_BOOST:
+                effects = dataclasses.replace(effects, bass=int(value))
+            elif setting == 'speed' and value in SPEED_PRESETS:
+                speed, pitch = SPEED_PRESETS[value]
+                effects = dataclasses.replace(effects, speed=speed, pitch=pitch)
+            elif setting == 'speed' and 0.5 <= float(value) <= 2.0:
+                effects = dataclasses.replace(effects, speed=float(value), pitch=False)
+            elif setting == 'crossfade' and 0 <= float(value) <= MAX_CROSSFADE:
+                effects = dataclasses.replace(effects, crossfade=float(value))
+            else:
+                return await ctx.send(f"❌ {usage}")
+        except ValueError:
+            return await ctx.send(f"❌ {usage}")
+
+        try:
+            player.set_effects(effects)
+        except Exception as e:
+            return await ctx.send(f"❌ Couldn't apply effects: {str(e)}")
+        await ctx.send(f"Audio effects: {effects.describe()}")
+
+    @commands.command(name='stats')
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx):
+        """Show playback, executor and cache statistics for the bot"""
+        def timing(histogram, **labels):
+            count, mean, p95 = histogram.summary(**labels)
+            if not count:
+                return "no samples"
+            return f"avg {mean:.2f}s · p95 ≤ {p95:g}s · n={count}"
+
+        playing = sum(1 for player in self.players.values() if player.current_player)
+        queued = sum(len(player.song_queue) for player in self.players.values())
+        embed = discord.Embed(title="Bot Statistics", color=discord.Color.blue())
+        embed.add_field(
+            name="Players",
+            value=f"{len(self.players)} guilds · {playing} playing · {queued} songs queued",
+            inline=False
+        )
+        embed.add_field(name="Time to first audio", value=timing(metrics.time_to_first_audio_seconds), inline=False)
+        embed.add_field(name="Gap between tracks", value=timing(metrics.track_gap_seconds), inline=False)
+        embed.add_field(
+            name="Executors",
+            value="\n".join(
+                f"{name}: {pool.pending}/{pool.max_pending} pending · {timing(metrics.executor_call_seconds, pool=name)}"
+                for name, pool in pools.items()
+            ),
+            inline=False
+        )
+        search = self.search_cache.stats()
+        cache = audio_cache.stats()
+        embed.add_field(
+            name="Caches",
+            value=(
+                f"Search: {search['hits']} hits / {search['misses']} misses ({search['size']} entries)\n"
+                f"Lyrics: {self.lyrics_service.hits} hits / {self.lyrics_service.misses} misses\n"
+                f"Audio: {cache['files']} files ({cache['bytes'] // (1024 * 1024)} MB)\n"
+                f"Spotify API calls: {self.spotify_service.api_calls}"
+            ),
+            inline=False
+        )
+        embed.add_field(name="Queue store writes", value=timing(metrics.queue_store_seconds, op='flush'), inline=False)
+        await ctx.send(embed=embed)
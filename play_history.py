@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from queue_manager import QueuedSong
+
+PLAY_HISTORY_PATH = os.getenv('PLAY_HISTORY_PATH', 'play_history.db')
+# Plays kept before the oldest ones are pruned
+PLAY_HISTORY_SIZE = int(os.getenv('PLAY_HISTORY_SIZE', '200000'))
+# A guild's most recent plays, which autoplay will not pick again
+AUTOPLAY_RECENT_EXCLUDE = int(os.getenv('AUTOPLAY_RECENT_EXCLUDE', '50'))
+# Pruning runs once per this many plays rather than on every one
+PRUNE_EVERY = 500
+
+class PlayHistory:
+    """SQLite log of every song a guild started, and how each play ended
+
+    Each play records the song played before it in the same guild, so
+    "what do people play after this" is one indexed lookup. Plays started
+    by autoplay have no requester and are left out of those counts, so
+    autoplay never reinforces its own picks.
+    """
+    def __init__(self, path: str = PLAY_HISTORY_PATH, max_plays: int = PLAY_HISTORY_SIZE):
+        self.path = path
+        self.max_plays = max_plays
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._db = None  # Opened on first use
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # Commits skip the fsync; a crash can lose the last few plays, never corrupt the log
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    video_id TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    duration INTEGER NOT NULL,
+                    artist TEXT NOT NULL,
+                    completions INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS plays (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER NOT NULL,
+                    video_id TEXT NOT NULL,
+                    previous_id TEXT,
+                    requester_id INTEGER,
+                    started_at REAL NOT NULL,
+                    completed INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS idx_plays_recent ON plays (guild_id);
+                CREATE INDEX IF NOT EXISTS idx_plays_guild_tracks ON plays (guild_id, completed, video_id);
+                CREATE INDEX IF NOT EXISTS idx_plays_previous ON plays (previous_id, video_id);
+                CREATE INDEX IF NOT EXISTS idx_tracks_completions ON tracks (completions);
+            ''')
+            self._db.commit()
+        return self._db
+
+    def record_start(self, guild_id: int, song: QueuedSong, requester_id: Optional[int]) -> int:
+        """Log a song starting in a guild; returns the play's id for `record_finish`"""
+        with self._lock:
+            db = self.db
+            previous = db.execute(
+                'SELECT video_id FROM plays WHERE guild_id = ? ORDER BY id DESC LIMIT 1', (guild_id,)
+            ).fetchone()
+            db.execute(
+                '''INSERT INTO tracks (video_id, title, url, duration, artist) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(video_id) DO UPDATE SET title = excluded.title, url = excluded.url,
+                   duration = excluded.duration, artist = excluded.artist''',
+                (song.video_id, song.title, song.url, song.duration or 0, song.artist)
+            )
+            play_id = db.execute(
+                'INSERT INTO plays (guild_id, video_id, previous_id, requester_id, started_at) VALUES (?, ?, ?, ?, ?)',
+                (guild_id, song.video_id, previous[0] if previous else None, requester_id, time.time())
+            ).lastrowid
+            self._inserts += 1
+            if self._inserts % PRUNE_EVERY == 0:
+                self._prune()
+            db.commit()
+        return play_id
+
+    def record_finish(self, play_id: int, completed: bool) -> None:
+        """Mark how a play ended: played through, or skipped partway"""
+        with self._lock:
+            db = self.db
+            updated = db.execute(
+                'UPDATE plays SET completed = ? WHERE id = ? AND completed IS NULL', (int(completed), play_id)
+            ).rowcount
+            if updated and completed:
+                db.execute(
+                    'UPDATE tracks SET completions = completions + 1 '
+                    'WHERE video_id = (SELECT video_id FROM plays WHERE id = ?)',
+                    (play_id,)
+                )
+            db.commit()
+
+    def _prune(self) -> None:
+        """Drop the oldest plays beyond max_plays (lock held)"""
+        self._db.execute(
+            'DELETE FROM plays WHERE id <= (SELECT MAX(id) FROM plays) - ?', (self.max_plays,)
+        )
+
+    def recommend(self, guild_id: int, seed_id: str, exclude=(), limit: int = 5) -> List[QueuedSong]:
+        """Songs to play after `seed_id`, best first, skipping the guild's recent plays and `exclude`
+
+        Songs people chose right after the seed come first, then this
+        guild's most completed songs, then the most completed anywhere.
+        Skipped plays never count towards a song.
+        """
+        with self._lock:
+            db = self.db
+            excluded = set(exclude) | {seed_id} | {row[0] for row in db.execute(
+                'SELECT video_id FROM plays WHERE guild_id = ? ORDER BY id DESC LIMIT ?',
+                (guild_id, AUTOPLAY_RECENT_EXCLUDE)
+            )}
+            # Over-fetch so enough survive the exclusions
+            fetch = limit + len(excluded)
+            ranked = []
+            for query, params in (
+                ('''SELECT video_id FROM plays WHERE previous_id = ? AND requester_id IS NOT NULL
+                    AND completed IS NOT 0 GROUP BY video_id ORDER BY COUNT(*) DESC LIMIT ?''', (seed_id, fetch)),
+                ('''SELECT video_id FROM plays WHERE guild_id = ? AND completed = 1
+                    GROUP BY video_id ORDER BY COUNT(*) DESC LIMIT ?''', (guild_id, fetch)),
+                ('SELECT video_id FROM tracks WHERE completions > 0 ORDER BY completions DESC LIMIT ?', (fetch,)),
+            ):
+                for (video_id,) in db.execute(query, params):
+                    if video_id not in excluded:
+                        excluded.add(video_id)
+                        ranked.append(video_id)
+                if len(ranked) >= limit:
+                    break
+            ranked = ranked[:limit]
+            rows = {row[0]: row[1:] for row in db.execute(
+                f"SELECT video_id, title, url, duration, artist FROM tracks WHERE video_id IN ({','.join('?' * len(ranked))})",
+                ranked
+            )} if ranked else {}
+        return [
+            QueuedSong(title=rows[video_id][0], url=rows[video_id][1], duration=rows[video_id][2], artist=rows[video_id][3])
+            for video_id in ranked if video_id in rows
+        ]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+play_history = PlayHistory()
@@ -1,8 +1,46 @@
+import asyncio
+import collections
+import itertools
 import json
-import pickle
+import os
+import random
+import sqlite3
+import threading
+import time
 from pathlib import Path
-from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import metrics
+
+# Fallback lifetime for stream URLs that don't advertise an expiry
+DEFAULT_STREAM_TTL = 3600
+# Extra slack on top of the track length before a stream URL counts as stale
+STREAM_EXPIRY_MARGIN = 60
+
+QUEUE_STATE_PATH = os.getenv('QUEUE_STATE_PATH', 'queue_state.db')
+# Seconds queue changes are batched before being written to disk
+QUEUE_SAVE_DEBOUNCE = float(os.getenv('QUEUE_SAVE_DEBOUNCE', '2'))
+# Gap between neighbouring entries' sequence numbers, so a moved entry
+# usually fits between its new neighbours without renumbering the queue
+SEQUENCE_SPACING = 1 << 16
+
+def guess_artist(title: str) -> str:
+    """Try to extract the artist from a title (Artist - Title format)"""
+    if title and ' - ' in title:
+        return title.split(' - ')[0]
+    return 'Unknown Artist'
+
+def stream_expiry(stream_url: str) -> float:
+    """Return the unix time a resolved stream URL stops being valid"""
+    expire = parse_qs(urlparse(stream_url).query).get('expire')
+    if expire:
+        try:
+            return float(expire[0])
+        except ValueError:
+            pass
+    return time.time() + DEFAULT_STREAM_TTL
 
 @dataclass
 class QueuedSong:
@@ -10,28 +48,390 @@ class QueuedSong:
     url: str
     duration: int
     artist: str
+    # Resolved stream, filled in just before the song reaches the head of the queue
+    stream_url: Optional[str] = field(default=None, repr=False)
+    expires_at: float = field(default=0.0, repr=False)
+    codec: Optional[str] = field(default=None, repr=False)
+    # Seconds in to start at next time it plays, for a song interrupted mid-play
+    start: float = field(default=0.0, repr=False)
+
+    @classmethod
+    def from_entry(cls, entry: dict) -> 'QueuedSong':
+        """Build a song from a (possibly flat) yt-dlp entry without resolving it"""
+        title = entry.get('title') or entry.get('url')
+        url = entry.get('webpage_url') or entry.get('url')
+        if url and '://' not in url and not url.startswith('ytsearch'):
+            url = f"https://www.youtube.com/watch?v={url}"
+        return cls(
+            title=title,
+            url=url,
+            duration=entry.get('duration') or 0,
+            artist=entry.get('artist') or guess_artist(title)
+        )
+
+    @property
+    def video_id(self) -> str:
+        """YouTube video ID for the song, or its URL for other sources"""
+        parsed = urlparse(self.url)
+        if parsed.netloc.endswith('youtu.be'):
+            return parsed.path.lstrip('/')
+        video_id = parse_qs(parsed.query).get('v')
+        return video_id[0] if video_id else self.url
+
+    def is_resolved(self) -> bool:
+        """Whether the stream URL is still good for a full playthrough"""
+        if not self.stream_url:
+            return False
+        return time.time() + (self.duration or 0) + STREAM_EXPIRY_MARGIN < self.expires_at
+
+    def update_from_info(self, data: dict) -> None:
+        """Store the stream URL and refreshed metadata from a full extraction"""
+        self.stream_url = data['url']
+        self.expires_at = stream_expiry(self.stream_url)
+        self.codec = data.get('acodec')
+        self.title = data.get('title') or self.title
+        self.url = data.get('webpage_url') or self.url
+        self.duration = data.get('duration') or self.duration
+        self.artist = data.get('artist') or guess_artist(self.title)
+
+    def to_dict(self) -> dict:
+        """Serializable form; stream URLs are transient and never persisted"""
+        return {
+            'title': self.title,
+            'url': self.url,
+            'duration': self.duration,
+            'artist': self.artist
+        }
+
+@dataclass
+class QueueChanges:
+    """Edits made to a SongQueue since they were last taken, by entry sequence number"""
+    rewrite: bool = False  # `added` holds the whole queue; anything stored before is dropped
+    added: Dict[int, QueuedSong] = field(default_factory=dict)
+    removed: Set[int] = field(default_factory=set)
+
+class SongQueue:
+    """Deque of (song, ctx) entries with O(1) head/tail operations
+
+    Keeps a running total of queued seconds so large queues never need to
+    be walked just to report their length. Every entry also carries a
+    sequence number that orders the stored queue and never changes while
+    the entry is queued, so saving after an edit writes only the entries
+    that edit added or removed. Shuffling renumbers, and so rewrites, the
+    whole queue.
+    """
+    def __init__(self, entries=()):
+        self._entries = collections.deque()
+        self._sequences = collections.deque()  # Parallel to _entries, strictly increasing
+        self._changes = QueueChanges()
+        self.total_duration = 0
+        self.extend(entries)
+
+    @classmethod
+    def restored(cls, rows) -> 'SongQueue':
+        """A queue of stored (sequence, song) rows, in order, with nothing left to save"""
+        queue = cls()
+        for sequence, song in rows:
+            queue._entries.append((song, None))
+            queue._sequences.append(sequence)
+            queue.total_duration += song.duration or 0
+        return queue
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, index: int):
+        return self._entries[index]
+
+    def _added(self, sequence: int, entry) -> None:
+        self._changes.added[sequence] = entry[0]
+        self._changes.removed.discard(sequence)
+
+    def _removed(self, sequence: int) -> None:
+        self._changes.added.pop(sequence, None)
+        self._changes.removed.add(sequence)
+
+    def _renumber(self) -> None:
+        """Space the sequence numbers out again; the whole queue is saved next time"""
+        self._sequences = collections.deque(range(0, len(self._entries) * SEQUENCE_SPACING, SEQUENCE_SPACING))
+        self._changes = QueueChanges(rewrite=True)
+
+    def take_changes(self) -> QueueChanges:
+        """The edits since the last call, for `QueueManager.save_queue`"""
+        changes, self._changes = self._changes, QueueChanges()
+        if changes.rewrite:
+            changes.added = {sequence: song for sequence, (song, _) in zip(self._sequences, self._entries)}
+            changes.removed = set()
+        return changes
+
+    def append(self, entry) -> None:
+        sequence = self._sequences[-1] + SEQUENCE_SPACING if self._sequences else 0
+        self._entries.append(entry)
+        self._sequences.append(sequence)
+        self._added(sequence, entry)
+        self.total_duration += entry[0].duration or 0
+
+    def appendleft(self, entry) -> None:
+        sequence = self._sequences[0] - SEQUENCE_SPACING if self._sequences else 0
+        self._entries.appendleft(entry)
+        self._sequences.appendleft(sequence)
+        self._added(sequence, entry)
+        self.total_duration += entry[0].duration or 0
+
+    def extend(self, entries) -> None:
+        for entry in entries:
+            self.append(entry)
+
+    def popleft(self):
+        entry = self._entries.popleft()
+        self._removed(self._sequences.popleft())
+        self.total_duration -= entry[0].duration or 0
+        return entry
+
+    def head(self, count: int) -> list:
+        """The first `count` entries"""
+        return list(itertools.islice(self._entries, count))
+
+    def page(self, start: int, count: int) -> list:
+        """`count` entries starting at index `start`"""
+        return list(itertools.islice(self._entries, start, start + count))
+
+    def remove(self, index: int):
+        """Remove and return the entry at `index`"""
+        entry = self._entries[index]
+        del self._entries[index]
+        self._removed(self._sequences[index])
+        del self._sequences[index]
+        self.total_duration -= entry[0].duration or 0
+        return entry
+
+    def move(self, source: int, destination: int) -> None:
+        """Move the entry at `source` so it ends up at `destination`"""
+        entry = self._entries[source]
+        del self._entries[source]
+        self._removed(self._sequences[source])
+        del self._sequences[source]
+        destination = min(destination, len(self._entries))
+        before = self._sequences[destination - 1] if destination > 0 else None
+        after = self._sequences[destination] if destination < len(self._sequences) else None
+        self._entries.insert(destination, entry)
+        if before is not None and after is not None and after - before < 2:
+            self._renumber()  # No room left between the new neighbours
+            return
+        if before is None:
+            sequence = after - SEQUENCE_SPACING if after is not None else 0
+        elif after is None:
+            sequence = before + SEQUENCE_SPACING
+        else:
+            sequence = (before + after) // 2
+        self._sequences.insert(destination, sequence)
+        self._added(sequence, entry)
+
+    def shuffle(self) -> None:
+        entries = list(self._entries)
+        random.shuffle(entries)
+        self._entries = collections.deque(entries)
+        self._renumber()
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._sequences.clear()
+        self._changes = QueueChanges(rewrite=True)
+        self.total_duration = 0
+
+@dataclass
+class _GuildWrites:
+    """One guild's changes waiting for the next flush"""
+    rewrite: bool = False  # Delete the guild's stored queue before writing `rows`
+    rows: Dict[int, tuple] = field(default_factory=dict)  # sequence -> queue row to write
+    deleted: Set[int] = field(default_factory=set)  # Sequences to delete
+    current: Optional[tuple] = None  # The current_songs row, or None to clear it
 
 class QueueManager:
-    def __init__(self, save_file: str = 'queue_state.json'):
+    """Persists each guild's queue in SQLite with debounced background flushes
+
+    Saves record only what changed: queue rows are keyed by the entries'
+    stable sequence numbers (see SongQueue), so a track change writes a
+    couple of rows however long the queue is. A flush runs on the executor
+    at most once per `debounce` seconds and applies every guild's pending
+    changes inside a single transaction, so a crash leaves either the old
+    or the new state on disk, never a partial one.
+    """
+    def __init__(self, save_file: str = QUEUE_STATE_PATH, debounce: float = QUEUE_SAVE_DEBOUNCE,
+                 legacy_file: str = 'queue_state.json'):
         self.save_file = Path(save_file)
-        self.save_file.touch(exist_ok=True)
+        self.debounce = debounce
+        self._pending = {}  # guild ID -> _GuildWrites waiting to be flushed
+        self._positions = {}  # guild ID -> current song offset waiting to be flushed
+        self._flush_scheduled = False
+        self._lock = threading.Lock()  # Guards _pending
+        self._db_lock = threading.Lock()  # Serializes flushes so changes land in order
+        self._db = sqlite3.connect(self.save_file, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS queue_songs (
+                guild_id INTEGER NOT NULL,
+                sequence INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                url TEXT NOT NULL,
+                duration INTEGER NOT NULL,
+                artist TEXT NOT NULL,
+                start REAL NOT NULL,
+                PRIMARY KEY (guild_id, sequence)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS current_songs (
+                guild_id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                url TEXT NOT NULL,
+                duration INTEGER NOT NULL,
+                artist TEXT NOT NULL,
+                start REAL NOT NULL
+            );
+        ''')
+        self._db.commit()
+        self._report_legacy(Path(legacy_file))
 
-    def save_queue(self, current_song: Optional[QueuedSong], queue: List[QueuedSong]) -> None:
-        """Save the current queue state to file"""
-        state = {
-            'current_song': vars(current_song) if current_song else None,
-            'queue': [vars(song) for song in queue]
-        }
-        with open(self.save_file, 'w') as f:
-            json.dump(state, f)
+    def _report_legacy(self, legacy_file: Path) -> None:
+        """Point out a queue saved by the old single-queue version, which no server can be matched to
 
-    def load_queue(self) -> Tuple[Optional[QueuedSong], List[QueuedSong]]:
-        """Load the queue state from file"""
+        That version kept one queue for every server with no guild ID, so
+        it is left on disk untouched rather than restored into a guess.
+        """
         try:
-            with open(self.save_file, 'r') as f:
+            with open(legacy_file, 'r') as f:
                 state = json.load(f)
-                current_song = QueuedSong(**state['current_song']) if state['current_song'] else None
-                queue = [QueuedSong(**song) for song in state['queue']]
-                return current_song, queue
         except (json.JSONDecodeError, FileNotFoundError):
-            return None, []
+            return  # The old version created the file empty until something was queued
+        if not isinstance(state, dict):
+            return
+        count = len(state.get('queue') or []) + (1 if state.get('current_song') else 0)
+        if count:
+            print(
+                f"{legacy_file} holds {count} song(s) queued by an older version that kept one queue for "
+                f"every server. It can't be matched to a server, so it was not restored; queue the songs "
+                f"again and delete the file to stop this message."
+            )
+
+    def save_queue(self, guild_id: int, current_song: Optional[QueuedSong], changes: QueueChanges,
+                   offset: float = 0.0) -> None:
+        """Record a guild's queue edits and current song; they are written by the next debounced flush"""
+        rows = {
+            sequence: (guild_id, sequence, song.title, song.url, song.duration or 0, song.artist, song.start)
+            for sequence, song in changes.added.items()
+        }
+        current = None
+        if current_song:
+            current = (guild_id, current_song.title, current_song.url,
+                       current_song.duration or 0, current_song.artist, offset)
+        with self._lock:
+            if changes.rewrite or guild_id not in self._pending:
+                self._pending[guild_id] = _GuildWrites(rewrite=changes.rewrite)
+            writes = self._pending[guild_id]
+            for sequence in changes.removed:
+                writes.rows.pop(sequence, None)
+            writes.deleted |= changes.removed
+            writes.deleted -= rows.keys()
+            writes.rows.update(rows)
+            writes.current = current
+            self._positions.pop(guild_id, None)
+        self._schedule_flush()
+
+    def save_position(self, guild_id: int, offset: float) -> None:
+        """Record how far into its current song a guild is, without touching its queue"""
+        with self._lock:
+            writes = self._pending.get(guild_id)
+            if writes and writes.current:
+                writes.current = writes.current[:5] + (offset,)
+            else:
+                self._positions[guild_id] = offset
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        """Arrange a debounced flush unless one is already due"""
+        with self._lock:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (shutdown or scripts): write straight away
+            self._flush_scheduled = False
+            self.flush()
+            return
+        loop.call_later(self.debounce, self._start_flush, loop)
+
+    def _start_flush(self, loop) -> None:
+        """Hand the pending snapshots to the executor"""
+        with self._lock:
+            self._flush_scheduled = False
+        loop.run_in_executor(None, self._flush_logged)
+
+    def _flush_logged(self) -> None:
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error saving queue state: {e}")
+
+    def flush(self) -> None:
+        """Apply every guild's pending changes in one transaction (blocking)"""
+        with self._db_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                positions, self._positions = self._positions, {}
+            if not pending and not positions:
+                return
+            with metrics.queue_store_seconds.time(op='flush'), self._db:
+                for guild_id, writes in pending.items():
+                    if writes.rewrite:
+                        self._db.execute('DELETE FROM queue_songs WHERE guild_id = ?', (guild_id,))
+                    elif writes.deleted:
+                        self._db.executemany(
+                            'DELETE FROM queue_songs WHERE guild_id = ? AND sequence = ?',
+                            [(guild_id, sequence) for sequence in writes.deleted]
+                        )
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO queue_songs VALUES (?, ?, ?, ?, ?, ?, ?)', writes.rows.values()
+                    )
+                    if writes.current:
+                        self._db.execute('INSERT OR REPLACE INTO current_songs VALUES (?, ?, ?, ?, ?, ?)', writes.current)
+                    else:
+                        self._db.execute('DELETE FROM current_songs WHERE guild_id = ?', (guild_id,))
+                self._db.executemany(
+                    'UPDATE current_songs SET start = ? WHERE guild_id = ?',
+                    [(offset, guild_id) for guild_id, offset in positions.items()]
+                )
+
+    def load_all(self) -> Dict[int, Tuple[Optional[QueuedSong], SongQueue]]:
+        """Load every guild's saved current song and queue, with one query per table"""
+        self.flush()  # Anything still pending is part of the saved state
+        with self._db_lock, metrics.queue_store_seconds.time(op='load_all'):
+            queued = self._db.execute(
+                'SELECT guild_id, sequence, title, url, duration, artist, start FROM queue_songs '
+                'ORDER BY guild_id, sequence'
+            ).fetchall()
+            current = self._db.execute(
+                'SELECT guild_id, title, url, duration, artist, start FROM current_songs'
+            ).fetchall()
+
+        states = {
+            guild_id: (None, SongQueue.restored(
+                (sequence, QueuedSong(title=title, url=url, duration=duration, artist=artist, start=start))
+                for _, sequence, title, url, duration, artist, start in rows
+            ))
+            for guild_id, rows in itertools.groupby(queued, key=lambda row: row[0])
+        }
+        for guild_id, title, url, duration, artist, start in current:
+            queue = states[guild_id][1] if guild_id in states else SongQueue()
+            states[guild_id] = (QueuedSong(title=title, url=url, duration=duration, artist=artist, start=start), queue)
+        return states
+
+    def close(self) -> None:
+        """Flush outstanding state and close the store"""
+        self.flush()
+        with self._db_lock:
+            self._db.close()
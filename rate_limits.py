@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+import metrics
+from executors import extraction_pool
+
+# Command budget per user and per guild: tokens refilled per second, and bucket size
+USER_RATE = float(os.getenv('USER_RATE', '0.5'))
+USER_BURST = float(os.getenv('USER_BURST', '5'))
+GUILD_RATE = float(os.getenv('GUILD_RATE', '2'))
+GUILD_BURST = float(os.getenv('GUILD_BURST', '20'))
+# Commands over budget wait up to this many seconds before being refused
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '5'))
+
+# Cost weights: a command that needs a lookup, one answered from a cache, and each playlist track
+COMMAND_COST = 1.0
+CACHED_COST = 0.25
+PLAYLIST_TRACK_COST = 0.1
+
+# Extraction jobs admitted at once across all guilds, and the share one guild may hold.
+# Kept near the worker count so waiting happens here, in fair order, not in the pool's queue.
+ADMISSION_CAPACITY = int(os.getenv('ADMISSION_CAPACITY') or extraction_pool.workers * 2)
+ADMISSION_GUILD_SHARE = float(os.getenv('ADMISSION_GUILD_SHARE', '0.25'))
+# Share of capacity bulk work (playlist imports) may use, leaving the rest for playback
+ADMISSION_BULK_SHARE = float(os.getenv('ADMISSION_BULK_SHARE', '0.5'))
+# Seconds a job may wait for admission before it is refused
+ADMISSION_TIMEOUT = float(os.getenv('ADMISSION_TIMEOUT', '60'))
+
+# Buckets kept before full (idle) ones are forgotten
+MAX_BUCKETS = 10000
+
+class AdmissionRejected(Exception):
+    """Raised when a guild's work waited too long for extraction capacity"""
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `burst`
+
+    Charges may overdraw the bucket, so one large request (a big playlist)
+    is let through and later requests wait until the debt is paid off.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until the bucket has a token to spend"""
+        self._refill()
+        if self.tokens > 0 or self.rate <= 0:
+            return 0.0
+        return -self.tokens / self.rate + 0.01
+
+    def charge(self, cost: float) -> None:
+        self._refill()
+        self.tokens -= cost
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+class RateLimiter:
+    """Per-user and per-guild token buckets for expensive commands"""
+    def __init__(self, user_rate: float = USER_RATE, user_burst: float = USER_BURST,
+                 guild_rate: float = GUILD_RATE, guild_burst: float = GUILD_BURST):
+        self.user_limits = (user_rate, user_burst)
+        self.guild_limits = (guild_rate, guild_burst)
+        self._buckets = {}  # ('user' or 'guild', ID) -> TokenBucket
+
+    def _bucket(self, scope: str, key: int) -> TokenBucket:
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune()
+            bucket = TokenBucket(*(self.user_limits if scope == 'user' else self.guild_limits))
+            self._buckets[(scope, key)] = bucket
+        return bucket
+
+    def _prune(self) -> None:
+        """Forget buckets that have refilled completely; they hold no state"""
+        for key in [key for key, bucket in self._buckets.items() if bucket.is_full()]:
+            del self._buckets[key]
+
+    def delay(self, user_id: int, guild_id: int) -> float:
+        """Seconds before this user may run another expensive command in this guild"""
+        return max(self._bucket('user', user_id).delay(), self._bucket('guild', guild_id).delay())
+
+    def charge(self, user_id: int, guild_id: int, cost: float) -> None:
+        self._bucket('user', user_id).charge(cost)
+        self._bucket('guild', guild_id).charge(cost)
+
+class AdmissionController:
+    """Bounds extraction work in flight, with a per-guild cap so one guild can't starve the rest
+
+    Jobs over a limit wait their turn; a job that waits longer than
+    `timeout` is refused with AdmissionRejected. Bulk jobs (imports) are
+    held to a smaller share of capacity and counted apart from playback,
+    so a guild's own import never delays its next song. The per-guild cap
+    only applies while another guild has work waiting; a lone guild may
+    use the whole capacity. Owned by the cog, so its condition lives on
+    the loop the cog runs on.
+    """
+    def __init__(self, capacity: int = ADMISSION_CAPACITY, guild_share: float = ADMISSION_GUILD_SHARE,
+                 bulk_share: float = ADMISSION_BULK_SHARE, timeout: float = ADMISSION_TIMEOUT):
+        self.capacity = max(1, capacity)
+        self.guild_limit = max(1, int(self.capacity * guild_share))
+        self.bulk_limit = max(1, int(self.capacity * bulk_share))
+        self.timeout = timeout
+        self.in_use = 0
+        self.by_guild = {}  # (guild ID, bulk) -> cost admitted
+        self.waiting = {}  # guild ID -> jobs waiting for admission
+        self._changed = asyncio.Condition()
+
+    def _fits(self, guild_id: int, cost: float, bulk: bool) -> bool:
+        if self.in_use + cost > (self.bulk_limit if bulk else self.capacity):
+            return False
+        others_waiting = any(waiting != guild_id for waiting in self.waiting)
+        return not others_waiting or self.by_guild.get((guild_id, bulk), 0) + cost <= self.guild_limit
+
+    @asynccontextmanager
+    async def slot(self, guild_id: int, cost: float = 1, bulk: bool = False):
+        """Hold `cost` units of extraction capacity for a guild while the block runs"""
+        key = (guild_id, bulk)
+        async with self._changed:
+            if not self._fits(guild_id, cost, bulk):
+                metrics.admission_waits_total.inc()
+                self.waiting[guild_id] = self.waiting.get(guild_id, 0) + 1
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait_for(lambda: self._fits(guild_id, cost, bulk)), self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    metrics.admission_rejected_total.inc()
+                    raise AdmissionRejected("Too much work queued for this server right now, try again shortly")
+                finally:
+                    self.waiting[guild_id] -= 1
+                    if not self.waiting[guild_id]:
+                        del self.waiting[guild_id]
+                        # Other guilds may no longer be held to their cap
+                        self._changed.notify_all()
+            self.in_use += cost
+            self.by_guild[key] = self.by_guild.get(key, 0) + cost
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self.in_use -= cost
+                self.by_guild[key] -= cost
+                if self.by_guild[key] <= 0:
+                    del self.by_guild[key]
+                self._changed.notify_all()
+
@@ -0,0 +1,91 @@
+import asyncio
+import os
+from urllib.parse import urlparse
+
+# Concurrent lookups per playlist import
+RESOLVER_WORKERS = int(os.getenv('RESOLVER_WORKERS', '4'))
+# Maximum requests per second sent to any single host
+RESOLVER_HOST_RATE = float(os.getenv('RESOLVER_HOST_RATE', '5'))
+
+# Host that yt-dlp searches and bare video IDs are looked up on
+SEARCH_HOST = 'www.youtube.com'
+
+def url_host(url: str) -> str:
+    """Host a lookup will hit, used as the rate limiting key"""
+    if url.startswith('ytsearch'):
+        return SEARCH_HOST
+    return urlparse(url).netloc or SEARCH_HOST
+
+class HostRateLimiter:
+    """Spaces out requests so no host sees more than `rate` per second"""
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_slot = {}  # host -> earliest time the next request may start
+
+    async def acquire(self, host: str) -> None:
+        """Wait for this host's next free slot"""
+        if not self.interval:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot.get(host, now))
+        self._next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class PlaylistResolver:
+    """Resolves playlist items on a bounded worker pool, yielding them in order"""
+    def __init__(self, workers: int = RESOLVER_WORKERS, host_rate: float = RESOLVER_HOST_RATE):
+        self.workers = max(1, workers)
+        # How far workers may run ahead of the oldest item not yet yielded
+        self.window = self.workers * 4
+        self.rate_limiter = HostRateLimiter(host_rate)
+
+    async def resolve(self, items, resolve, *, host=None, on_progress=None):
+        """Yield (index, result) in playlist order as soon as each item is ready
+
+        `resolve` is a coroutine function called once per item. Failed items
+        yield None so callers can skip them without losing their place.
+        `host` is the rate limiting key for every lookup; by default it is
+        each item's own URL host. `on_progress(done, total)` is called each
+        time a lookup finishes.
+        """
+        items = list(items)
+        total = len(items)
+        results = {}
+        emitted = 0
+        done = 0
+        ready = asyncio.Condition()
+        indexes = iter(range(total))
+
+        async def worker():
+            nonlocal done
+            for index in indexes:
+                async with ready:
+                    await ready.wait_for(lambda: index < emitted + self.window)
+                item = items[index]
+                try:
+                    await self.rate_limiter.acquire(host or url_host(item))
+                    result = await resolve(item)
+                except Exception as e:
+                    print(f"Error resolving playlist item {index + 1}: {e}")
+                    result = None
+                done += 1
+                if on_progress:
+                    on_progress(done, total)
+                async with ready:
+                    results[index] = result
+                    ready.notify_all()
+
+        tasks = [asyncio.create_task(worker()) for _ in range(min(self.workers, total))]
+        try:
+            while emitted < total:
+                async with ready:
+                    await ready.wait_for(lambda: emitted in results)
+                    result = results.pop(emitted)
+                    emitted += 1
+                    ready.notify_all()
+                yield emitted - 1, result
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,135 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Optional
+
+from queue_manager import QueuedSong
+
+SEARCH_CACHE_PATH = os.getenv('SEARCH_CACHE_PATH', 'search_cache.db')
+# Entries kept before the least recently used ones are evicted
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '10000'))
+# Seconds a cached search result stays valid (default 30 days)
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', str(30 * 24 * 3600)))
+# Eviction runs once per this many inserts rather than on every one
+EVICT_EVERY = 100
+# Hits whose last_used times are held in memory before they are written out
+TOUCH_FLUSH_EVERY = 500
+
+def normalize_query(query: str) -> str:
+    """Fold case, Unicode compatibility forms, punctuation and spacing"""
+    query = unicodedata.normalize('NFKC', query).casefold()
+    return re.sub(r'[\W_]+', ' ', query).strip()
+
+class SearchCache:
+    """SQLite-backed map from search queries and Spotify IDs to YouTube videos"""
+    def __init__(self, path: str = SEARCH_CACHE_PATH, max_entries: int = SEARCH_CACHE_SIZE,
+                 ttl: int = SEARCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._touched = {}  # key -> last_used not yet written; saved with the next write
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Commits skip the fsync; a crash can lose recent entries, never corrupt the cache
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS search_results (
+                key TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                url TEXT NOT NULL,
+                duration INTEGER NOT NULL,
+                artist TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS idx_search_last_used ON search_results (last_used)')
+        self._db.commit()
+
+    @staticmethod
+    def query_key(query: str) -> str:
+        return f"q:{normalize_query(query)}"
+
+    @staticmethod
+    def spotify_key(track_id: str) -> str:
+        return f"spotify:{track_id}"
+
+    def get(self, key: str) -> Optional[QueuedSong]:
+        """Return the cached song for a key, or None on a miss or expired entry"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT title, url, duration, artist, created_at FROM search_results WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row and now - row[4] > self.ttl:
+                self._db.execute('DELETE FROM search_results WHERE key = ?', (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            # Hits are the common case, so their last_used is batched rather than committed each time
+            self._touched[key] = now
+            if len(self._touched) >= TOUCH_FLUSH_EVERY:
+                self._flush_touched()
+                self._db.commit()
+            self.hits += 1
+        return QueuedSong(title=row[0], url=row[1], duration=row[2], artist=row[3])
+
+    def contains(self, key: str) -> bool:
+        """Whether a live entry exists, without counting a hit or miss"""
+        with self._lock:
+            row = self._db.execute('SELECT created_at FROM search_results WHERE key = ?', (key,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def put(self, key: str, song: QueuedSong) -> None:
+        """Cache a resolved song under a key, evicting the least recently used overflow"""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, song.title, song.url, song.duration or 0, song.artist, now, now)
+            )
+            self._touched.pop(key, None)
+            self._flush_touched()
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                self._evict()
+            self._db.commit()
+
+    def _flush_touched(self) -> None:
+        """Write batched last_used times, uncommitted (lock held)"""
+        if self._touched:
+            self._db.executemany(
+                'UPDATE search_results SET last_used = ? WHERE key = ?',
+                [(used, key) for key, used in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _evict(self) -> None:
+        """Drop the least recently used entries beyond max_entries (lock held)"""
+        self._db.execute(
+            '''DELETE FROM search_results WHERE key IN (
+                SELECT key FROM search_results ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )''',
+            (self.max_entries,)
+        )
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            size = self._db.execute('SELECT COUNT(*) FROM search_results').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._db.commit()
+            self._db.close()
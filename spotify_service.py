@@ -0,0 +1,189 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from executors import metadata_pool
+
+SPOTIFY_CACHE_PATH = os.getenv('SPOTIFY_CACHE_PATH', 'spotify_cache.db')
+# Seconds cached track metadata stays valid (default 90 days)
+SPOTIFY_CACHE_TTL = int(os.getenv('SPOTIFY_CACHE_TTL', str(90 * 24 * 3600)))
+# Maximum IDs accepted by the batch tracks endpoint
+TRACKS_BATCH_SIZE = 50
+
+_SPOTIFY_LINK = re.compile(r'(?:open\.spotify\.com/(?:intl-\w+/)?|spotify:)(track|playlist|album|artist)[/:]([A-Za-z0-9]+)')
+
+def parse_spotify_url(url: str) -> Optional[Tuple[str, str]]:
+    """Return (kind, id) for a Spotify track/playlist/album/artist link or URI"""
+    match = _SPOTIFY_LINK.search(url)
+    return (match.group(1), match.group(2)) if match else None
+
+@dataclass
+class SpotifyTrack:
+    id: str
+    artist: str
+    title: str
+    isrc: Optional[str]
+    duration: int  # seconds
+
+    @property
+    def search_query(self) -> str:
+        return f"{self.artist} - {self.title}"
+
+    @classmethod
+    def from_api(cls, track: dict) -> 'SpotifyTrack':
+        return cls(
+            id=track['id'],
+            artist=track['artists'][0]['name'] if track.get('artists') else 'Unknown Artist',
+            title=track['name'],
+            isrc=(track.get('external_ids') or {}).get('isrc'),
+            duration=(track.get('duration_ms') or 0) // 1000
+        )
+
+class SpotifyService:
+    """Spotify metadata with batched lookups and a persistent track cache
+
+    All API calls run on the metadata executor. The spotipy client is
+    built there on first use, and its client credentials token is cached
+    and reused until it expires.
+    """
+    def __init__(self, client_id: Optional[str] = None, client_secret: Optional[str] = None,
+                 path: str = SPOTIFY_CACHE_PATH, ttl: int = SPOTIFY_CACHE_TTL):
+        self.client_id = client_id or os.getenv('SPOTIFY_CLIENT_ID')
+        self.client_secret = client_secret or os.getenv('SPOTIFY_CLIENT_SECRET')
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.ttl = ttl
+        self.api_calls = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS spotify_tracks (
+                id TEXT PRIMARY KEY,
+                artist TEXT NOT NULL,
+                title TEXT NOT NULL,
+                isrc TEXT,
+                duration INTEGER NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        ''')
+        self._db.commit()
+
+    @property
+    def client(self):
+        """The spotipy client, imported and built on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    with metrics.client_init_seconds.time(client='spotify'):
+                        import spotipy
+                        from spotipy.oauth2 import SpotifyClientCredentials
+                        self._client = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
+                            client_id=self.client_id,
+                            client_secret=self.client_secret
+                        ))
+        return self._client
+
+    async def _call(self, method: str, *args, **kwargs):
+        """Run one Spotify API call, by client method name, on the metadata executor"""
+        self.api_calls += 1
+        return await metadata_pool.run(lambda: getattr(self.client, method)(*args, **kwargs))
+
+    def _cached(self, track_ids: List[str]) -> Dict[str, SpotifyTrack]:
+        if not track_ids:
+            return {}
+        placeholders = ','.join('?' * len(track_ids))
+        with self._lock:
+            rows = self._db.execute(
+                f'SELECT id, artist, title, isrc, duration FROM spotify_tracks '
+                f'WHERE fetched_at > ? AND id IN ({placeholders})',
+                (time.time() - self.ttl, *track_ids)
+            ).fetchall()
+        return {row[0]: SpotifyTrack(*row) for row in rows}
+
+    def _store(self, tracks: List[SpotifyTrack]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO spotify_tracks VALUES (?, ?, ?, ?, ?, ?)',
+                [(t.id, t.artist, t.title, t.isrc, t.duration, now) for t in tracks]
+            )
+            self._db.commit()
+
+    async def tracks(self, track_ids: List[str]) -> List[SpotifyTrack]:
+        """Metadata for many tracks, fetching uncached ones 50 at a time"""
+        known = {}
+        for start in range(0, len(track_ids), 900):  # Stay under SQLite's variable limit
+            known.update(self._cached(track_ids[start:start + 900]))
+        missing = list(dict.fromkeys(track_id for track_id in track_ids if track_id not in known))
+
+        for start in range(0, len(missing), TRACKS_BATCH_SIZE):
+            results = await self._call('tracks', missing[start:start + TRACKS_BATCH_SIZE])
+            fetched = [SpotifyTrack.from_api(track) for track in results['tracks'] if track]
+            self._store(fetched)
+            known.update((track.id, track) for track in fetched)
+
+        return [known[track_id] for track_id in track_ids if track_id in known]
+
+    async def track(self, track_id: str) -> Optional[SpotifyTrack]:
+        tracks = await self.tracks([track_id])
+        return tracks[0] if tracks else None
+
+    async def playlist_tracks(self, playlist_id: str) -> List[SpotifyTrack]:
+        """Every playable track in a playlist; pages carry full track objects"""
+        results = await self._call(
+            'playlist_items', playlist_id, additional_types=('track',),
+            fields='items(track(id,name,duration_ms,artists(name),external_ids)),next'
+        )
+        tracks = []
+        while True:
+            for item in results['items']:
+                track = item.get('track')
+                if track and track.get('id'):  # Local files and unavailable tracks have no ID
+                    tracks.append(SpotifyTrack.from_api(track))
+            if not results.get('next'):
+                break
+            results = await self._call('next', results)
+        self._store(tracks)
+        return tracks
+
+    async def album_tracks(self, album_id: str) -> List[SpotifyTrack]:
+        """Album tracks; listings lack ISRCs, so they are completed via the batch endpoint"""
+        results = await self._call('album_tracks', album_id, limit=50)
+        track_ids = []
+        while True:
+            track_ids.extend(track['id'] for track in results['items'] if track.get('id'))
+            if not results.get('next'):
+                break
+            results = await self._call('next', results)
+        return await self.tracks(track_ids)
+
+    async def artist_top_tracks(self, artist_id: str) -> List[SpotifyTrack]:
+        results = await self._call('artist_top_tracks', artist_id)
+        tracks = [SpotifyTrack.from_api(track) for track in results['tracks'] if track]
+        self._store(tracks)
+        return tracks
+
+    async def resolve_url(self, url: str) -> List[SpotifyTrack]:
+        """Tracks behind any supported Spotify link"""
+        parsed = parse_spotify_url(url)
+        if not parsed:
+            raise Exception("Unsupported Spotify link")
+        kind, spotify_id = parsed
+        if kind == 'track':
+            track = await self.track(spotify_id)
+            return [track] if track else []
+        if kind == 'playlist':
+            return await self.playlist_tracks(spotify_id)
+        if kind == 'album':
+            return await self.album_tracks(spotify_id)
+        return await self.artist_top_tracks(spotify_id)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
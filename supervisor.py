@@ -0,0 +1,110 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Bot processes to run; each owns an equal share of the shards
+WORKERS = int(os.getenv('WORKERS') or os.cpu_count() or 1)
+SHARD_COUNT = int(os.getenv('SHARD_COUNT') or WORKERS)
+# Seconds between worker launches, so shards don't all identify at once
+WORKER_START_DELAY = float(os.getenv('WORKER_START_DELAY', '5'))
+# Restart backoff doubles per crash up to the maximum, and resets once a worker stays up
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+STABLE_AFTER = 60
+
+def worker_shards(worker, workers=WORKERS, shard_count=SHARD_COUNT):
+    """Shard IDs run by a worker"""
+    return [shard_id for shard_id in range(shard_count) if shard_id % workers == worker]
+
+class Worker:
+    """One bot.py process running a fixed set of shards"""
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = RESTART_DELAY
+        self.restart_at = 0.0
+
+    def start(self):
+        env = dict(os.environ)
+        env['SHARD_COUNT'] = str(SHARD_COUNT)
+        env['SHARD_IDS'] = ','.join(map(str, worker_shards(self.index)))
+        # Every worker serves its own metrics on consecutive ports
+        if os.getenv('METRICS_PORT'):
+            env['METRICS_PORT'] = str(int(os.getenv('METRICS_PORT')) + self.index)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+        self.process = subprocess.Popen([sys.executable, script], env=env)
+        self.started_at = time.monotonic()
+        print(f"Worker {self.index} started (pid {self.process.pid}, shards {env['SHARD_IDS']})")
+
+    def check(self, now):
+        """Restart the worker with backoff if it has exited"""
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            if now - self.started_at > STABLE_AFTER:
+                self.restart_delay = RESTART_DELAY
+            return
+        print(f"Worker {self.index} exited with code {code}, restarting in {self.restart_delay}s")
+        self.process = None
+        self.restart_at = now + self.restart_delay
+        self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def stop(self):
+        """Ask the worker to shut down; bot.run closes the bot cleanly on SIGINT"""
+        if self.process and self.process.poll() is None:
+            if os.name == 'posix':
+                self.process.send_signal(signal.SIGINT)
+            else:
+                self.process.terminate()
+
+    def wait(self, timeout):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def main():
+    """Start every worker and keep them running until interrupted"""
+    if SHARD_COUNT < WORKERS:
+        sys.exit("SHARD_COUNT must be at least WORKERS")
+    workers = [Worker(index) for index in range(WORKERS)]
+    stopping = []
+
+    def shut_down(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, shut_down)
+    signal.signal(signal.SIGTERM, shut_down)
+
+    for worker in workers:
+        if stopping:
+            break
+        worker.start()
+        time.sleep(WORKER_START_DELAY)
+
+    while not stopping:
+        now = time.monotonic()
+        for worker in workers:
+            worker.check(now)
+        time.sleep(1)
+
+    print("Stopping workers...")
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        # Closing the bot unloads the cog, which flushes the queue store
+        worker.wait(timeout=15)
+
+if __name__ == '__main__':
+    main()
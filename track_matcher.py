@@ -0,0 +1,66 @@
+import os
+from typing import List, Optional, Tuple
+
+from search_cache import normalize_query
+from spotify_service import SpotifyTrack
+
+# Flat search results fetched and scored per Spotify track
+MATCH_CANDIDATES = int(os.getenv('MATCH_CANDIDATES', '5'))
+# Best score below which an ISRC search is tried as well
+MATCH_MIN_SCORE = float(os.getenv('MATCH_MIN_SCORE', '50'))
+
+# Words marking a different recording, penalized unless the Spotify title has them too
+_VERSION_WORDS = (
+    'live', 'cover', 'remix', 'karaoke', 'instrumental', 'acoustic', 'sped up',
+    'slowed', 'nightcore', 'reverb', '8d', 'reaction', 'tutorial'
+)
+
+def _contains(text: str, phrase: str) -> bool:
+    return f" {phrase} " in f" {text} "
+
+def score_candidate(track: SpotifyTrack, entry: dict) -> float:
+    """How likely a flat YouTube search result is the same recording as a Spotify track"""
+    title = normalize_query(entry.get('title') or '')
+    channel = normalize_query(entry.get('channel') or entry.get('uploader') or '')
+    song = normalize_query(track.title)
+    artist = normalize_query(track.artist)
+    score = 0.0
+
+    # Duration is the strongest signal: music videos and live cuts run long
+    duration = entry.get('duration')
+    if duration and track.duration:
+        difference = abs(duration - track.duration)
+        score += max(0.0, 40 * (1 - difference / 20))
+        if difference > 30:
+            score -= min(40, difference / 6)
+
+    words = song.split()
+    if words:
+        score += 30 * sum(_contains(title, word) for word in words) / len(words)
+    if artist and (_contains(title, artist) or _contains(channel, artist)):
+        score += 20
+
+    # Auto-generated "Artist - Topic" channels carry the studio recording
+    if channel.endswith(' topic'):
+        score += 15
+    if _contains(title, 'audio'):
+        score += 10
+    elif _contains(title, 'official video') or _contains(title, 'music video'):
+        score -= 5
+
+    for word in _VERSION_WORDS:
+        if _contains(title, word) and not _contains(song, word):
+            score -= 20
+    return score
+
+def best_match(track: SpotifyTrack, entries: List[dict]) -> Tuple[Optional[dict], float]:
+    """Highest scoring entry and its score; earlier results win ties"""
+    best, best_score = None, float('-inf')
+    for rank, entry in enumerate(entries):
+        if not entry:
+            continue
+        # A slight preference for YouTube's own ranking
+        score = score_candidate(track, entry) - rank
+        if score > best_score:
+            best, best_score = entry, score
+    return best, best_score
@@ -0,0 +1,159 @@
+import asyncio
+import os
+
+import metrics
+
+# Seconds to wait with an empty queue before leaving voice
+IDLE_DISCONNECT_DELAY = float(os.getenv('IDLE_DISCONNECT_DELAY', '180'))
+# Seconds to stay (paused) in a channel nobody is listening in before leaving
+EMPTY_CHANNEL_DELAY = float(os.getenv('EMPTY_CHANNEL_DELAY', '60'))
+# Reconnect attempts after voice drops unexpectedly; the delay doubles each time
+VOICE_RECONNECT_ATTEMPTS = int(os.getenv('VOICE_RECONNECT_ATTEMPTS', '3'))
+VOICE_RECONNECT_DELAY = 2
+
+def has_listeners(channel):
+    """Whether anyone other than bots is in a voice channel"""
+    return channel is not None and any(not member.bot for member in channel.members)
+
+def can_rejoin(channel):
+    """Whether a voice channel still exists and the bot may connect to it"""
+    guild = channel.guild
+    if guild.get_channel(channel.id) is None:
+        return False
+    permissions = channel.permissions_for(guild.me)
+    return permissions.connect and permissions.speak
+
+class VoiceLifecycle:
+    """Decides when a guild's voice connection is kept, dropped or re-established
+
+    There is at most one pending timer per guild: scheduling a new one
+    replaces the old, and it re-checks its condition when it fires. Leaving
+    on purpose goes through `leave`. Being kicked, or losing the channel or
+    the permission to join it, is final; any other disconnect is treated as
+    a drop and reconnected, resuming the interrupted song where it stopped.
+    """
+    def __init__(self, player):
+        self.player = player
+        self._timer = None  # (reason, task) for the pending disconnect
+        self._reconnect = None  # Task re-joining after a drop
+        self._leaving = False  # Set while we disconnect on purpose
+        self._paused_alone = False  # Playback we paused because the channel emptied
+
+    def _schedule(self, reason, delay, guild, ctx=None):
+        """Replace any pending timer with one that leaves after `delay` seconds"""
+        self.cancel_timer()
+        task = self.player.bot.loop.create_task(self._expire(reason, delay, guild, ctx))
+        self._timer = (reason, task)
+
+    def cancel_timer(self, reason=None):
+        """Cancel the pending timer, or only one set for `reason`"""
+        if self._timer and (reason is None or self._timer[0] == reason):
+            self._timer[1].cancel()
+            self._timer = None
+
+    def schedule_idle(self, ctx):
+        """Leave once the queue has stayed empty for IDLE_DISCONNECT_DELAY"""
+        self._schedule('idle', IDLE_DISCONNECT_DELAY, ctx.guild, ctx)
+
+    async def _expire(self, reason, delay, guild, ctx):
+        await asyncio.sleep(delay)
+        self._timer = None
+        voice_client = guild.voice_client
+        if reason == 'idle':
+            if not self.player.is_idle() or (voice_client and (voice_client.is_playing() or voice_client.is_paused())):
+                return
+            message = "Disconnected due to inactivity"
+        else:
+            if voice_client is None or has_listeners(voice_client.channel):
+                return
+            message = "Disconnected because everyone left the voice channel"
+        metrics.voice_disconnects_total.inc(reason=reason)
+        await self.leave(guild)
+        ctx = ctx or self.player.current_ctx
+        if ctx:
+            await ctx.send(message)
+
+    async def leave(self, guild):
+        """Disconnect on purpose, keeping any interrupted song queued to resume later"""
+        self.cancel_timer()
+        if self._reconnect:
+            self._reconnect.cancel()
+            self._reconnect = None
+        self._paused_alone = False
+        self.player.suspend()
+        if guild.voice_client:
+            self._leaving = True
+            await guild.voice_client.disconnect()
+        if self.player.is_idle():
+            self.player.destroy()
+
+    def joined(self, guild):
+        """The bot's voice state moved into a channel, by a command or a reconnect"""
+        self._leaving = False
+        self.listeners_changed(guild)
+        # A join that starts nothing (say a !play that found no results) still times out
+        if self._timer is None and self.player.is_idle():
+            self._schedule('idle', IDLE_DISCONNECT_DELAY, guild)
+
+    def listeners_changed(self, guild):
+        """Pause and start the empty-channel timer when the last listener leaves; undo it when one returns"""
+        voice_client = guild.voice_client
+        if voice_client is None:
+            return
+        if has_listeners(voice_client.channel):
+            self.cancel_timer('alone')
+            if self._paused_alone and voice_client.is_paused():
+                voice_client.resume()
+            self._paused_alone = False
+        elif not (self._timer and self._timer[0] == 'alone'):
+            if voice_client.is_playing():
+                voice_client.pause()
+                self._paused_alone = True
+            self._schedule('alone', EMPTY_CHANNEL_DELAY, guild)
+
+    def disconnected(self, channel):
+        """The bot's voice state went to no channel: our own leave, a removal, or a drop to recover from"""
+        if self._leaving:
+            self._leaving = False
+            return
+        # discord.py tears its client down before reporting a connection it gave up on,
+        # so one still registered here means Discord removed us (kicked, or the channel went)
+        removed = channel.guild.voice_client is not None
+        self.cancel_timer()
+        self._paused_alone = False
+        self.player.suspend()
+        ctx = self.player.interrupted_ctx()
+        # Only a session that was playing is resumed, and only for people still there
+        if ctx is None or removed or not can_rejoin(channel) or not has_listeners(channel) or self._reconnect:
+            return
+        self._reconnect = self.player.bot.loop.create_task(self._rejoin(channel, ctx))
+
+    async def _rejoin(self, channel, ctx):
+        """Reconnect with backoff and resume the interrupted song"""
+        delay = VOICE_RECONNECT_DELAY
+        try:
+            for _ in range(VOICE_RECONNECT_ATTEMPTS):
+                await asyncio.sleep(delay)
+                delay *= 2
+                if channel.guild.voice_client is None:
+                    if not can_rejoin(channel):
+                        break
+                    try:
+                        await channel.connect()
+                    except Exception as e:
+                        print(f"Error reconnecting to voice in guild {channel.guild.id}: {e}")
+                        continue
+                metrics.voice_reconnects_total.inc(result='ok')
+                self.player.play_next(ctx)
+                return
+            metrics.voice_reconnects_total.inc(result='failed')
+            await ctx.send("❌ Lost the voice connection. Use !resume to continue where playback stopped.")
+        finally:
+            self._reconnect = None
+
+    def close(self):
+        """Cancel pending timers and reconnects when the player is torn down"""
+        self.cancel_timer()
+        if self._reconnect:
+            self._reconnect.cancel()
+            self._reconnect = None
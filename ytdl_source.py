@@ -0,0 +1,280 @@
+import collections
+import os
+import threading
+import discord
+import metrics
+from audio_cache import audio_cache
+from audio_effects import AudioEffects, build_filter, loudness_cache
+from executors import extraction_pool
+from queue_manager import guess_artist
+
+# pcm: decode to PCM and scale volume in Python (default)
+# opus: hand Opus packets straight to discord.py, copying the codec at 100% volume
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'pcm').lower()
+
+# YT-DLP options
+ytdl_format_options = {
+    'format': 'bestaudio/best',
+    'restrictfilenames': True,
+    'noplaylist': False,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',
+    # Optimize for audio quality
+    'preferredcodec': 'opus',
+    'preferredquality': '192',
+    # Enable fast start
+    'buffersize': 32768,
+    'audio_buffer_size': 50000,
+    # Use yt-dlp specific options
+    'extract_flat': True,
+    'extractor_retries': 3,
+    'http_chunk_size': 10485760,
+}
+
+if PLAYBACK_MODE == 'opus':
+    # Prefer WebM/Opus streams, which can be passed through without re-encoding
+    ytdl_format_options['format'] = 'bestaudio[acodec=opus]/bestaudio/best'
+
+ffmpeg_options = {
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-loglevel error -bufsize 32k -maxrate 160k'
+}
+# Fixed headroom in pcm mode, where the user volume is applied in Python on top
+PCM_BASE_VOLUME = 0.5
+# Volume guilds start at; in opus mode 100% is the level Opus streams pass through untouched at
+DEFAULT_VOLUME = 1.0 if PLAYBACK_MODE == 'opus' else 0.5
+
+_ytdl = None
+_ytdl_lock = threading.Lock()
+
+def get_ytdl():
+    """The shared YoutubeDL, imported and built on first use (usually on an extraction thread)"""
+    global _ytdl
+    if _ytdl is None:
+        with _ytdl_lock:
+            if _ytdl is None:
+                with metrics.client_init_seconds.time(client='yt-dlp'):
+                    import yt_dlp
+                    _ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+    return _ytdl
+
+# discord.py sends one 20ms frame per read
+FRAMES_PER_SECOND = 50
+
+def create_ffmpeg_source(location, *, cached=False, codec=None, start=0, audio_filter=''):
+    """Open FFmpeg on a stream or cached file in the configured playback mode
+
+    `audio_filter` is the whole -af chain (effects and, in opus mode, gain).
+    In opus mode an Opus input with no filtering is copied untouched.
+    """
+    # Cached tracks are local files, so they need no reconnect handling
+    before_options = '' if cached else ffmpeg_options['before_options']
+    if start:
+        before_options = f"-ss {start:.2f} {before_options}".strip()
+    options = f'-vn -af "{audio_filter}"' if audio_filter else '-vn'
+
+    if PLAYBACK_MODE == 'opus':
+        if not audio_filter and codec == 'opus':
+            return discord.FFmpegOpusAudio(location, codec='opus', before_options=before_options, options='-vn')
+        return discord.FFmpegOpusAudio(location, before_options=before_options, options=options)
+    return discord.FFmpegPCMAudio(
+        location, before_options=before_options, options=f"{options} {ffmpeg_options['options']}"
+    )
+
+class PrebufferedAudio(discord.AudioSource):
+    """Audio source that can read frames ahead before playback starts"""
+    def __init__(self, original):
+        self.original = original
+        self._buffer = collections.deque()
+
+    def prebuffer(self, frames):
+        """Read up to `frames` frames into memory (blocking)"""
+        for _ in range(frames):
+            data = self.original.read()
+            if not data:
+                break
+            self._buffer.append(data)
+
+    def read(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        return self.original.read()
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self._buffer.clear()
+        self.original.cleanup()
+
+class YTDLSource(discord.AudioSource):
+    def __init__(self, data, *, song=None, volume=DEFAULT_VOLUME, cached=False, start=0, effects=None):
+        self.data = data
+        self.song = song
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self.webpage_url = data.get('webpage_url') or self.url
+        self.duration = data.get('duration') or 0
+        # Try to extract artist from title (Artist - Title format)
+        self.artist = data.get('artist') or guess_artist(data.get('title', ''))
+        self.frames_read = 0
+        # Track position at the last (re)start, and frames_read at that moment
+        self._base_position = start
+        self._base_frame = 0
+        self._near_end_at = None
+        self._on_near_end = None
+        self._every_frames = None
+        self._on_every = None
+        self._cached = cached
+        self._codec = data.get('acodec')
+        self._volume = volume
+        self._effects = effects or AudioEffects()
+        self._lock = threading.Lock()  # Held while reading or swapping FFmpeg processes
+        self.original = self._open(start)
+
+    def _open(self, start):
+        """Start FFmpeg for this track at `start` seconds with the current volume and effects"""
+        loudness = None
+        if self._effects.normalize:
+            loudness = loudness_cache.get(self.song.video_id if self.song else self.url)
+        gain = self._volume if PLAYBACK_MODE == 'opus' else PCM_BASE_VOLUME
+        self._buffered = PrebufferedAudio(create_ffmpeg_source(
+            self.url, cached=self._cached, codec=self._codec, start=start,
+            audio_filter=build_filter(self._effects, gain, loudness, start, self.duration)
+        ))
+        if PLAYBACK_MODE == 'opus':
+            return self._buffered
+        return discord.PCMVolumeTransformer(self._buffered, self._volume)
+
+    def restart(self, start):
+        """Replace the FFmpeg process, resuming at `start` seconds"""
+        source = self._open(start)
+        with self._lock:
+            old, self.original = self.original, source
+            self._base_position, self._base_frame = start, self.frames_read
+        old.cleanup()
+
+    @property
+    def effects(self):
+        return self._effects
+
+    @effects.setter
+    def effects(self, value):
+        """Swap the filter graph, continuing from the current position"""
+        if value == self._effects:
+            return
+        position = self.position
+        self._effects = value
+        self.restart(position)
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        if value == self._volume:
+            return
+        self._volume = value
+        if PLAYBACK_MODE == 'opus':
+            # Gain lives in the FFmpeg filter graph, so rebuild it where we are
+            self.restart(self.position)
+        else:
+            self.original.volume = value
+
+    @property
+    def cached(self):
+        """Whether this plays from the local audio cache rather than a stream"""
+        return self._cached
+
+    def seek(self, start, url=None):
+        """Jump to `start` seconds, optionally on a freshly resolved stream URL"""
+        if url:
+            self.url = url
+        self.restart(max(0, start))
+
+    @property
+    def position(self):
+        """Seconds into the track, counted from frames handed to the voice client"""
+        played = (self.frames_read - self._base_frame) / FRAMES_PER_SECOND
+        # Speed effects play more (or less) than a second of the track per second
+        return self._base_position + played * self._effects.speed
+
+    def read(self):
+        with self._lock:
+            data = self.original.read()
+            if data:
+                self.frames_read += 1
+        if not data:
+            return data
+        # Checked with >= so seeking past the mark still fires it, once
+        if self._on_near_end and self.position >= self._near_end_at:
+            callback, self._on_near_end = self._on_near_end, None
+            callback()
+        if self._on_every and self.frames_read % self._every_frames == 0:
+            self._on_every()
+        return data
+
+    def is_opus(self):
+        return PLAYBACK_MODE == 'opus'
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def notify_near_end(self, callback, lead):
+        """Call `callback` from the audio thread `lead` seconds before the song ends"""
+        if not self.duration:
+            return
+        self._on_near_end = callback
+        self._near_end_at = max(1 / FRAMES_PER_SECOND, self.duration - lead)
+
+    def notify_every(self, callback, seconds):
+        """Call `callback` from the audio thread every `seconds` of playback"""
+        self._on_every = callback
+        self._every_frames = max(1, int(seconds * FRAMES_PER_SECOND))
+
+    def prebuffer(self, seconds):
+        """Decode the first `seconds` of audio ahead of playback (blocking)"""
+        self._buffered.prebuffer(int(seconds * FRAMES_PER_SECOND))
+
+    @classmethod
+    async def resolve(cls, song):
+        """Resolve a queued song's stream URL, reusing it until it expires"""
+        if song.is_resolved():
+            return song
+
+        data = await extraction_pool.run(lambda: get_ytdl().extract_info(song.url, download=False))
+
+        if 'entries' in data:
+            if not data['entries']:
+                raise Exception(f"No YouTube results found for {song.title}")
+            data = data['entries'][0]
+        # Search results come back flat, so they need a second pass for the stream
+        if data.get('_type') == 'url':
+            search_hit = data['url']
+            data = await extraction_pool.run(lambda: get_ytdl().extract_info(search_hit, download=False))
+
+        song.update_from_info(data)
+        return song
+
+    @classmethod
+    async def from_song(cls, song, *, volume=DEFAULT_VOLUME, start=0, effects=None):
+        """Create a player for a queued song, from the local cache or its stream, `start` seconds in"""
+        cached = audio_cache.lookup(song)
+        if not cached:
+            await cls.resolve(song)
+        data = {
+            'title': song.title,
+            'url': cached or song.stream_url,
+            'webpage_url': song.url,
+            'duration': song.duration,
+            'artist': song.artist,
+            # The audio cache always stores Opus
+            'acodec': 'opus' if cached else song.codec
+        }
+        return cls(data, song=song, volume=volume, cached=bool(cached), start=start, effects=effects)